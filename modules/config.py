@@ -37,6 +37,7 @@ def config(version):
     cli_parser.add_argument("-f", dest="configfile", default="default.conf", metavar="FILE", help="configuration file (default: %(default)s)")
     cli_parser.add_argument("-o", dest="logfile", default=None, metavar="FILE", help="enable logging output to FILE.")
     cli_parser.add_argument("-v", action="store_true", dest="verbose", default=False, help="enable verbose debug output to stdout/logfile")
+    cli_parser.add_argument("--migrate", action="store_true", dest="migrate", default=False, help="migrate database to the current schema version and exit")
     
     conf = cli_parser.parse_args()
     
@@ -50,6 +51,13 @@ def config(version):
     conf.pidfile        = file_parser.get("general", "pidfile")
     conf.certfile       = file_parser.get("general", "certfile")
     conf.use_tls        = file_parser.getboolean("general", "tls")
+    conf.handshakes     = file_parser.getint("general", "handshakes")
+    conf.engine         = file_parser.get("general", "engine")
+    conf.ringsize       = file_parser.getint("general", "ringsize")
+    conf.queuelimit     = file_parser.getint("general", "queuelimit")
+    conf.overflow       = file_parser.get("general", "overflow")
+    conf.trace          = file_parser.getboolean("general", "trace")
+    conf.lograte        = file_parser.getint("general", "lograte")
 
     conf.db_type        = file_parser.get("database", "type")
     conf.db_host        = file_parser.get("database", "host")
@@ -57,26 +65,62 @@ def config(version):
     conf.db_user        = file_parser.get("database", "user")
     conf.db_pass        = file_parser.get("database", "password")
     conf.db_file        = file_parser.get("database", "file")
+    conf.db_batchsize   = file_parser.getint("database", "batchsize")
+    conf.db_batchtime   = file_parser.getint("database", "batchtime")
+    conf.db_queuesize   = file_parser.getint("database", "queuesize")
+    conf.db_partition   = file_parser.get("database", "partition")
+    conf.db_retention   = file_parser.getint("database", "retention")
+    conf.db_archive     = file_parser.get("database", "archive")
+    conf.db_poolsize    = file_parser.getint("database", "poolsize")
+    conf.db_poolidle    = file_parser.getint("database", "poolidle")
+    conf.db_authttl     = file_parser.getint("database", "authttl")
     
     conf.csp_enable     = file_parser.getboolean("csp", "enable")
     conf.csp_host       = file_parser.getint("csp", "address")
     conf.can_ifc        = file_parser.get("csp", "interface")
+    conf.csp_conntimeout = file_parser.getint("csp", "conntimeout")
+    conf.csp_maxconns   = file_parser.getint("csp", "maxconns")
+    conf.uplink_weights = [int(w) for w in file_parser.get("csp", "weights").split(",")]
+    conf.uplink_lanesize = file_parser.getint("csp", "lanesize")
     
     conf.track_enable   = file_parser.getboolean("tracking", "enable")
     conf.tleurl         = file_parser.get("tracking", "tleurl")
     conf.tleupdate      = file_parser.getint("tracking", "tleupdate")
-    conf.spacecraft     = file_parser.get("tracking", "spacecraft")
+    conf.tlecache       = file_parser.get("tracking", "tlecache")
     conf.doppler        = file_parser.get("tracking", "doppler")
     conf.frequency      = file_parser.getfloat("tracking", "frequency")
+    conf.conflict       = file_parser.get("tracking", "conflict")
+    conf.handover       = file_parser.getint("tracking", "handover")
     conf.radioaddress   = file_parser.getint("tracking", "radioaddress")
     conf.radioport      = file_parser.getint("tracking", "radioport")
+    conf.radiostep      = file_parser.getfloat("tracking", "radiostep")
     conf.gslat          = file_parser.get("tracking", "gslat")
     conf.gslong         = file_parser.get("tracking", "gslong")
     conf.gselv          = file_parser.getint("tracking", "gselv")
     conf.minelv         = file_parser.getfloat("tracking", "minelv")
+    conf.scheduledays   = file_parser.getint("tracking", "schedule")
+    conf.trackresolution = file_parser.getfloat("tracking", "resolution")
+    conf.trackinterval  = file_parser.getfloat("tracking", "interval")
     conf.rotortype      = file_parser.get("tracking", "rotortype")
     conf.rotorport      = file_parser.get("tracking", "rotorport")
     conf.rotorspeed     = file_parser.getint("tracking", "rotorspeed")
+    conf.rotordeadband  = file_parser.getfloat("tracking", "rotordeadband")
+    conf.rotorreadback  = file_parser.getfloat("tracking", "rotorreadback")
+
+    # Spacecraft are listed as NAME[:PRIORITY[:FREQUENCY]] separated by commas
+    conf.spacecraft = []
+    for entry in file_parser.get("tracking", "spacecraft").split(","):
+        fields = [field.strip() for field in entry.split(":")]
+        conf.spacecraft.append((
+            fields[0],
+            int(fields[1]) if len(fields) > 1 else 0,
+            float(fields[2]) if len(fields) > 2 else conf.frequency))
+
+    conf.playback_enable = file_parser.getboolean("playback", "enable")
+    conf.playback_start = file_parser.get("playback", "start")
+    conf.playback_stop  = file_parser.get("playback", "stop")
+    conf.playback_speed = file_parser.getfloat("playback", "speed")
+    conf.playback_loop  = file_parser.getboolean("playback", "loop")
 
     conf.web_enable        = file_parser.getboolean("web", "enable")
     conf.web_port        = file_parser.getint("web", "port")
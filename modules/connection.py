@@ -28,17 +28,38 @@ import hashlib
 import re
 import sys
 import select
+import calendar
+import binascii
+import itertools
 
 # AAUSAT3 imports
 import server
 import database
 import csp
+import pycsp
+import ring
+import metrics
+import tracing
+import logqueue
+import schedule
+
+# Maximum number of packets read from the ring in one go
+READ_CHUNK = 256
+
+# Parse a replay time. Either microseconds after the epoch as used in PACKET
+# lines, or a UTC time formatted as YYYY-MM-DDTHH:MM:SS
+def parse_time(s):
+    if re.search("^[0-9]+$", s):
+        return int(s)
+    else:
+        return calendar.timegm(time.strptime(s, "%Y-%m-%dT%H:%M:%S")) * 1000000
 
 class reader(threading.Thread):
-    def __init__(self, mcclog, queue, socket, address, csem):
+    def __init__(self, mcclog, conn, ring, socket, address, csem):
         threading.Thread.__init__(self, None)
         self.mcclog = mcclog
-        self.queue = queue
+        self.conn = conn
+        self.ring = ring
         self.socket = socket
         self.address = address
         self.csem = csem
@@ -52,45 +73,419 @@ class reader(threading.Thread):
 
     def run(self):
         while self.running:
+            # Skip packets while forwarding is disabled
+            if not self.conn.enabled:
+                self.conn.cursor = self.ring.head
+
+            # Wait to be notified of new packets
+            if not self.conn.enabled or self.ring.skip(self.conn, self.conn.cursor) >= self.ring.head:
+                self.conn.wake.wait(0.5)
+                self.conn.wake.clear()
+                continue
+
+            lines = self.conn.forward(READ_CHUNK)
+            if lines == []:
+                continue
+            if lines == None:
+                # Client is too slow. Let the connection thread close it
+                self.running = False
+                self.conn.running = False
+
+            self.csem.acquire()
             try:
-                packet = self.queue.get(True, 0.1)
-                self.csem.acquire()
-                self.socket.write("PACKET {0}\n".format(packet.tostring()))
-                self.csem.release()
-            except Queue.Empty:
-                pass
+                if lines == None:
+                    self.socket.write(self.conn.slow())
+                else:
+                    self.socket.write("".join(lines))
+                    if not self.conn.traced == None:
+                        tracing.written(self.conn.traced)
+                        self.conn.traced = None
             except socket.error:
                 self.mcclog.error("Failed to send packet to {0}".format(self.address))
             finally:
                 self.csem.release()
 
-class connection(threading.Thread):
-    def __init__ (self, mcclog, socket, address, dbmanager, connlist, outqueue):
-        threading.Thread.__init__(self, None)
+# Metrics
+FORWARDED_PACKETS = metrics.REGISTRY.counter("mcc_client_packets_total", "Packets forwarded to clients")
+FORWARDED_BYTES = metrics.REGISTRY.counter("mcc_client_bytes_total", "Bytes of packets forwarded to clients")
+DROPPED_PACKETS = metrics.REGISTRY.counter("mcc_client_dropped_total", "Packets dropped for clients falling behind")
+REPLAYED_PACKETS = metrics.REGISTRY.counter("mcc_replay_packets_total", "Packets replayed to clients")
+
+# Client identifiers
+ids = itertools.count(1)
+
+# Client protocol shared by the threaded and the reactor client engines
+# Subclasses provide write(), delay() and notify()
+class handler():
+    def __init__(self, mcclog, address, dbmanager, connlist, ring, outqueue, conf):
         self.mcclog = mcclog
-        self.socket = socket
+        self.id = ids.next()
         self.address = address
         self.dbmanager = dbmanager
         self.connlist = connlist
+        self.ring = ring
         self.outqueue = outqueue
-        self.queue = Queue.Queue()
-
-        # Get database connection
-        self.db = self.dbmanager.get_connection()
 
-        # Connection semaphore
-        self.csem = threading.Semaphore()
+        # Maximum number of packets waiting to be forwarded and overflow policy
+        if conf.queuelimit > 0:
+            self.limit = min(conf.queuelimit, self.ring.size)
+        else:
+            self.limit = self.ring.size
+        self.policy = conf.overflow
 
         self.authorized = False
         self.enabled = False
         self.user = "unknown"
 
+        # Position of the next packet to forward from the ring
+        self.cursor = 0
+
+        # Subscribed (source, dport) keys. None forwards all packets
+        self.subscription = None
+
+        # Packets left to send before the rest are dropped (drop-newest)
+        self.accepted = None
+
+        # Forwarding statistics
+        self.dropped = 0
+        self.highwater = 0
+
+        # Latency traces of the last packets read from the ring
+        self.traced = None
+
+        # Packets left to replay
+        self.replaying = None
+
         # Failed login attempts
         self.failed = 0
         self.max_failed = 3
 
+    def greeting(self):
+        users = len(self.connlist)
+        self.write("* OK AAUSAT3 MCC Server {0} ready ({1} {2} connected)\n".format(server.VERSION, users, "user" if users == 1 else "users"))
+
+    def overrun(self, lost):
+        self.dropped += lost
+        DROPPED_PACKETS.inc(lost)
+        self.mcclog.warning("Connection {0}@{1} fell behind - {2} packets lost".format(self.user, self.address, lost))
+        return "* OVERRUN {0} packets lost\n".format(lost)
+
+    def slow(self):
+        self.mcclog.warning("Connection {0}@{1} exceeded backlog of {2} packets - closing connection".format(self.user, self.address, self.limit))
+        return "* FAIL Client too slow - closing connection\n"
+
+    # Number of subscribed packets waiting to be forwarded
+    def backlog(self):
+        return self.ring.backlog(self)
+
+    # Read at most num packets from the ring, applying the backlog limit.
+    # Returns the lines to send, or None if the connection must be closed
+    def forward(self, num):
+        lost = 0
+        backlog = self.ring.backlog(self)
+        self.highwater = max(self.highwater, backlog)
+
+        if self.accepted == None and backlog > self.limit:
+            if self.policy == "disconnect":
+                return None
+            elif self.policy == "drop-oldest":
+                (self.cursor, lost) = self.ring.drop(self.cursor, backlog - self.limit, self.subscription, self)
+            elif self.policy == "drop-newest":
+                # Send the accepted packets, then drop what arrived meanwhile
+                self.accepted = self.limit
+
+
+        traces = [] if tracing.enabled else None
+        (lines, self.cursor, overrun) = self.ring.read(self.cursor, num, self.subscription, traces, self)
+        dropped = 0
+        if not self.accepted == None:
+            if len(lines) >= self.accepted:
+                # Drop everything after the accepted packets
+                dropped = len(lines) - self.accepted
+                lines = lines[:self.accepted]
+                if not traces == None:
+                    del traces[len(lines):]
+                (self.cursor, rest) = self.ring.drop(self.cursor, self.ring.backlog(self), self.subscription, self)
+                dropped += rest
+                self.accepted = None
+            else:
+                self.accepted -= len(lines)
+        if traces:
+            self.traced = tracing.dequeued(traces)
+        if lines:
+            FORWARDED_PACKETS.inc(len(lines))
+            FORWARDED_BYTES.inc(sum([len(line) for line in lines]))
+        lost += overrun
+        if lost:
+            lines.insert(0, self.overrun(lost))
+        if dropped:
+            lines.append(self.overrun(dropped))
+        return lines
+
+    # Handle a single command line. Returns False if the connection should be closed
+    def handle(self, msg):
+        # Split to fields
+        msg = msg.strip().split()
+
+        # Extract command
+        cmd = msg[0].upper()
+
+        if cmd == "USER":
+            if len(msg) == 3:
+                (user, password) = (msg[1], hashlib.sha1(msg[2]).hexdigest())
+                return self.defer(lambda: self.dbmanager.validate_user(user, password), lambda valid, error: self.login(user, valid, error))
+            else:
+                self.write("USER FAIL Invalid format\n")
+                self.mcclog.debug("Received invalid USER command from {0}@{1}".format(self.user, self.address))
+
+        elif cmd == "SEND":
+            if self.authorized:
+                # Optional priority suffix, e.g. PRIO high
+                prio = pycsp.CSP_PRIO_NORM
+                if len(msg) == 5 and msg[3].upper() == "PRIO":
+                    prio = dict(csp.LANES).get(msg[4].lower())
+                    msg = msg[:3]
+
+                if len(msg) == 3 and not prio == None and re.search("^(3[01]|[0-2]?[0-9]):(6[0-3]|[0-5]?[0-9])$", msg[1]) and re.search("^([0-9a-f]{2}){1,256}$", msg[2]):
+                    id = msg[1].split(":")
+                    # Add packet to outgoing buffer
+                    # Source host and port is added by CSP implementation
+                    packet = csp.packet(-1, -1, int(id[0]), int(id[1]), binascii.unhexlify(msg[2]), prio)
+                    try:
+                        self.outqueue.put(packet, False)
+                    except Queue.Full:
+                        self.write("SEND FAIL Unable to add packet to outgoing queue\n")
+                        self.mcclog.debug("Packet queue full for {0}@{1}".format(self.user, self.address))
+                    else:
+                        self.write("SEND OK Packet sent\n")
+                        self.mcclog.debug("Added CSP packet from %s@%s to outgoing queue: %s", self.user, self.address, packet, extra=logqueue.PACKET)
+                else:
+                    self.write("SEND FAIL Invalid format\n")
+                    self.mcclog.debug("Received invalid SEND command from {0}@{1}".format(self.user, self.address))
+            else:
+                self.write("SEND FAIL Please login first\n")
+                self.mcclog.debug("User not authorized to SEND")
+
+        elif cmd == "REPLAY":
+            if self.authorized:
+                return self.defer(lambda: self.find_replay(msg), self.replay_started)
+            else:
+                self.write("REPLAY FAIL Please login first\n")
+                self.mcclog.debug("Received unauthorized REPLAY request from {0}".format(self.address))
+
+        elif cmd == "START":
+            if self.authorized:
+                self.ring.subscribe(self, self.subscription or [ring.ALL])
+                self.cursor = self.ring.head
+                self.accepted = None
+                self.enabled = True
+                self.write("START OK Packet forwarding started\n")
+                self.mcclog.debug("Starting packet forwarding to {0}@{1}".format(self.user, self.address))
+            else:
+                self.write("START FAIL Please login first\n")
+                self.mcclog.debug("Received unauthorized START request from {0}".format(self.address))
+
+        elif cmd == "STOP":
+            if self.authorized:
+                self.enabled = False
+                self.ring.unsubscribe(self)
+                self.write("STOP OK Packet forwarding stopped\n")
+                self.mcclog.debug("Stopping packet forwarding to {0}@{1}".format(self.user, self.address))
+            else:
+                self.write("STOP FAIL Please login first\n")
+                self.mcclog.debug("Received unauthorized STOP request from {0}".format(self.address))
+
+        elif cmd == "SUBSCRIBE":
+            if self.authorized:
+                keys = []
+                if len(msg) == 2:
+                    for item in msg[1].split(","):
+                        if not re.search("^(\*|3[01]|[0-2]?[0-9]):(\*|6[0-3]|[0-5]?[0-9])$", item):
+                            keys = []
+                            break
+                        keys.append(tuple([None if f == "*" else int(f) for f in item.split(":")]))
+
+                if keys:
+                    if ring.ALL in keys:
+                        self.subscription = None
+                        self.write("SUBSCRIBE OK Subscribed to all packets\n")
+                    else:
+                        self.subscription = frozenset(keys)
+                        self.write("SUBSCRIBE OK Subscribed to {0} {1}\n".format(len(keys), "filter" if len(keys) == 1 else "filters"))
+                    self.mcclog.debug("Subscribed {0}@{1} to {2}".format(self.user, self.address, msg[1]))
+                    if self.enabled:
+                        self.ring.subscribe(self, self.subscription or [ring.ALL])
+                        self.cursor = self.ring.head
+                        self.accepted = None
+                else:
+                    self.write("SUBSCRIBE FAIL Invalid format\n")
+                    self.mcclog.debug("Received invalid SUBSCRIBE command from {0}@{1}".format(self.user, self.address))
+            else:
+                self.write("SUBSCRIBE FAIL Please login first\n")
+                self.mcclog.debug("Received unauthorized SUBSCRIBE request from {0}".format(self.address))
+
+        elif cmd == "STATS":
+            if self.authorized:
+                values = metrics.REGISTRY.summary()
+                self.write("STATS OK {0} values\n".format(len(values)) + "".join(["STAT {0} {1}\n".format(name, value) for (name, value) in values]))
+            else:
+                self.write("STATS FAIL Please login first\n")
+                self.mcclog.debug("Received unauthorized STATS request from {0}".format(self.address))
+
+        elif cmd == "PASSES":
+            if self.authorized:
+                if len(msg) == 1 or (len(msg) == 2 and msg[1].isdigit()):
+                    passes = schedule.SCHEDULE.upcoming(int(msg[1]) if len(msg) == 2 else None)
+                    self.write("PASSES OK {0} passes\n".format(len(passes)) + "".join(["PASS {0}\n".format(p) for p in passes]))
+                else:
+                    self.write("PASSES FAIL Invalid format\n")
+                    self.mcclog.debug("Received invalid PASSES command from {0}@{1}".format(self.user, self.address))
+            else:
+                self.write("PASSES FAIL Please login first\n")
+                self.mcclog.debug("Received unauthorized PASSES request from {0}".format(self.address))
+
+        elif cmd == "RELOAD":
+            if self.authorized:
+                return self.defer(self.dbmanager.reload_users, self.reloaded)
+            else:
+                self.write("RELOAD FAIL Please login first\n")
+                self.mcclog.debug("Received unauthorized RELOAD request from {0}".format(self.address))
+
+        elif cmd == "QUIT":
+            self.write("QUIT OK Closing connection\n")
+            return False
+
+        else:
+            self.write("* FAIL Invalid command '{0}'\n".format(cmd))
+            self.mcclog.debug("Received unknown command {0} from {1}".format(cmd, self.address))
+
+        return True
+
+    # Run work, which may block on the database, and pass its result and
+    # the exception raised to done. Returns what done returns. The reactor
+    # engine runs work on a worker thread instead
+    def defer(self, work, done):
+        try:
+            result = work()
+        except Exception as e:
+            return done(None, e)
+        return done(result, None)
+
+    # Complete a USER command. Returns False if the connection should be closed
+    def login(self, user, valid, error):
+        if not error == None:
+            self.write("USER FAIL Database unavailable\n")
+            self.mcclog.warning("Failed to authorize {0}@{1} ({2})".format(user, self.address, error))
+        elif valid:
+            self.authorized = True
+            self.user = user
+            self.write("USER OK Welcome {0}\n".format(user))
+            self.mcclog.debug("Successfully authorized {0}@{1}".format(user, self.address))
+        else:
+            self.delay(1)
+            self.write("USER FAIL Invalid username or password\n")
+            self.mcclog.debug("Failed to authorize {0}@{1}".format(user, self.address))
+            self.failed += 1
+            if self.failed >= self.max_failed:
+                self.mcclog.warning("Too many failed login attempts for {0}@{1} - closing connection".format(self.user, self.address))
+                self.write("* FAIL Too many failed login attempts\n")
+                return False
+        return True
+
+    def reloaded(self, users, error):
+        if not error == None:
+            self.write("RELOAD FAIL Database unavailable\n")
+            self.mcclog.warning("Failed to reload users for {0}@{1} ({2})".format(self.user, self.address, error))
+        else:
+            self.write("RELOAD OK Loaded {0} {1}\n".format(users, "user" if users == 1 else "users"))
+            self.mcclog.info("Reloaded {0} users for {1}@{2}".format(users, self.user, self.address))
+        return True
+
+    # Count the packets for a REPLAY command. Returns None if the command is invalid.
+    # A pooled connection is only held while a chunk is read
+    def find_replay(self, msg):
+        # Parse the arguments before checking a connection out
+        try:
+            if len(msg) == 2 and re.search("^[0-9]+$", msg[1]):
+                num = int(msg[1])
+                query = lambda db: db.replay(num)
+            elif len(msg) == 5 and msg[1].upper() == "FROM" and msg[3].upper() == "TO":
+                (start, stop) = (parse_time(msg[2]), parse_time(msg[4]))
+                query = lambda db: db.replay_range(start, stop)
+            elif len(msg) == 3 and msg[1].upper() == "SINCE":
+                start = parse_time(msg[2])
+                query = lambda db: db.replay_since(start)
+            else:
+                return None
+        except ValueError:
+            return None
+
+        with self.dbmanager.connection() as db:
+            return query(db)
+
+    def replay_started(self, replay, error):
+        if not error == None:
+            self.write("REPLAY FAIL Database error\n")
+            self.mcclog.warning("Failed to replay to {0}@{1} ({2})".format(self.user, self.address, error))
+        elif not replay == None:
+            self.replaying = replay
+            self.write("REPLAY OK Replaying {0} packets\n".format(replay.count))
+            self.mcclog.debug("Replaying {0} packets to {1}@{2}".format(replay.count, self.user, self.address))
+        else:
+            self.write("REPLAY FAIL Invalid format\n")
+            self.mcclog.debug("Received invalid REPLAY command from {0}@{1}".format(self.user, self.address))
+        return True
+
+    # Read the next chunk of a replay
+    def fetch_replay(self, replay):
+        with self.dbmanager.connection() as db:
+            return replay.fetch(db)
+
+    # Returns the next chunk of replayed packets, or None when done
+    def replay_chunk(self):
+        try:
+            packets = self.fetch_replay(self.replaying)
+        except Exception as e:
+            return self.replayed(None, e)
+        return self.replayed(packets, None)
+
+    # Format a chunk of replayed packets. Returns None when the replay is done
+    def replayed(self, packets, error):
+        if not error == None:
+            self.mcclog.warning("Replay to {0}@{1} failed ({2})".format(self.user, self.address, error))
+            self.end_replay()
+            return None
+        if packets == None:
+            self.end_replay()
+            return None
+        REPLAYED_PACKETS.inc(len(packets))
+        return "".join(["PACKET {0}\n".format(p.tostring()) for p in packets])
+
+    def end_replay(self):
+        self.replaying = None
+
+    def closed(self):
+        self.ring.unsubscribe(self)
+        self.end_replay()
+        self.connlist.remove(self)
+        self.mcclog.debug("Forwarding statistics for {0}@{1}: backlog high-water mark {2} packets, {3} packets dropped".format(self.user, self.address, self.highwater, self.dropped))
+        users = len(self.connlist)
+        self.mcclog.info("Closed connection from {0}@{1} - {2} {3} connected".format(self.user, self.address, users, "user" if users == 1 else "users"))
+
+class connection(threading.Thread, handler):
+    def __init__ (self, mcclog, socket, address, dbmanager, connlist, ring, outqueue, conf):
+        threading.Thread.__init__(self, None)
+        handler.__init__(self, mcclog, address, dbmanager, connlist, ring, outqueue, conf)
+        self.socket = socket
+
+        # Connection semaphore
+        self.csem = threading.Semaphore()
+
+        # Set when subscribed packets are added to the ring
+        self.wake = threading.Event()
+
         # Start threads
-        self.reader = reader(self.mcclog, self.queue, self.socket, self.address, self.csem)
+        self.reader = reader(self.mcclog, self, self.ring, self.socket, self.address, self.csem)
 
         self.running = True
         self.start()
@@ -100,13 +495,21 @@ class connection(threading.Thread):
         self.reader.join()
         self.running = False
 
+    def write(self, data):
+        self.socket.write(data)
+
+    def delay(self, seconds):
+        time.sleep(seconds)
+
+    def notify(self):
+        self.wake.set()
+
     def run(self):
         # Wait for connection to appear in list
         while not self.connlist.count(self):
             pass 
 
-        users = len(self.connlist)
-        self.socket.write("* OK AAUSAT3 MCC Server {0} ready ({1} {2} connected)\n".format(server.VERSION, users, "user" if users == 1 else "users")) 
+        self.greeting()
 
         while self.running:
             # Read messages and split on newline
@@ -153,107 +556,29 @@ class connection(threading.Thread):
                     self.stop()
                     break
 
-                # Split to fields
-                msg = msg.strip().split()
-
-                # Acquire connection semaphore
+                # Handle command while holding the connection semaphore
                 self.csem.acquire()
-        
-                # Extract command
-                cmd = msg[0].upper()
-
-                if cmd == "USER":
-                    if len(msg) == 3:
-                        if self.db.validate_user(msg[1], hashlib.sha1(msg[2]).hexdigest()):
-                            self.authorized = True
-                            self.user = msg[1]
-                            self.socket.write("USER OK Welcome {0}\n".format(msg[1]))
-                            self.mcclog.debug("Successfully authorized {0}@{1}".format(msg[1], self.address))
-                        else:
-                            time.sleep(1)
-                            self.socket.write("USER FAIL Invalid username or password\n")
-                            self.mcclog.debug("Failed to authorize {0}@{1}".format(msg[1], self.address))
-                            self.failed += 1
-                            if self.failed >= self.max_failed:
-                                self.mcclog.warning("Too many failed login attempts for {0}@{1} - closing connection".format(self.user, self.address))
-                                self.socket.write("* FAIL Too many failed login attempts\n")
-                                self.csem.release()
-                                self.stop()
-                                break
-                    else:
-                        self.socket.write("USER FAIL Invalid format\n")
-                        self.mcclog.debug("Received invalid USER command from {0}@{1}".format(self.user, self.address))
-
-                elif cmd == "SEND":
-                    if self.authorized:
-                        if len(msg) == 3 and re.search("^(3[01]|[0-2]?[0-9]):(6[0-3]|[0-5]?[0-9])$", msg[1]) and re.search("^([0-9a-f]{2}){1,256}$", msg[2]):
-                            id = msg[1].split(":")
-                            # Add packet to outgoing buffer
-                            # Source host and port is added by CSP implementation
-                            packet = csp.packet(-1, -1, int(id[0]), int(id[1]), tuple([int(d, 16) for d in re.findall("[0-9a-f]{2}", msg[2])]))
-                            try:
-                                self.outqueue.put(packet, True, 1)
-                            except Queue.Full:
-                                self.socket.write("SEND FAIL Unable to add packet to outgoing queue\n")
-                                self.mcclog.debug("Packet queue full for {0}@{1}".format(self.user, self.address))
-                            else:
-                                self.socket.write("SEND OK Packet sent\n")
-                                self.mcclog.debug("Added CSP packet from {0}@{1} to outgoing queue: {2}".format(self.user, self.address, packet.debug()))
-                        else:
-                            self.socket.write("SEND FAIL Invalid format\n")
-                            self.mcclog.debug("Received invalid SEND command from {0}@{1}".format(self.user, self.address))
-                    else:
-                        self.socket.write("SEND FAIL Please login first\n")
-                        self.mcclog.debug("User not authorized to SEND")
-
-                elif cmd == "REPLAY":
-                    if self.authorized:
-                        if len(msg) == 2 and re.search("^[0-9]+$", msg[1]):
-                            num = msg[1]
-                            lst = self.db.replay(num)
-                            self.socket.write("REPLAY OK Replaying {0} packets\n".format(len(lst)))
-                            self.mcclog.debug("Replaying {0} packets to {1}@{2}".format(len(lst), self.user, self.address))
-                            for p in lst:
-                                self.queue.put(p)
-                        else:
-                            self.socket.write("REPLAY FAIL Invalid format\n")
-                            self.mcclog.debug("Received invalid REPLAY command from {0}@{1}".format(self.user, self.address))
-                    else:
-                        self.socket.write("REPLAY FAIL Please login first\n")
-                        self.mcclog.debug("Received unauthorized REPLAY request from {0}".format(self.address))
-
-                elif cmd == "START":
-                    if self.authorized:
-                        self.enabled = True
-                        self.socket.write("START OK Packet forwarding started\n")
-                        self.mcclog.debug("Starting packet forwarding to {0}@{1}".format(self.user, self.address))
-                    else:
-                        self.socket.write("START FAIL Please login first\n")
-                        self.mcclog.debug("Received unauthorized START request from {0}".format(self.address))
-
-                elif cmd == "STOP":
-                    if self.authorized:
-                        self.enabled = False
-                        self.socket.write("STOP OK Packet forwarding stopped\n")
-                        self.mcclog.debug("Stopping packet forwarding to {0}@{1}".format(self.user, self.address))
-                    else:
-                        self.socket.write("STOP FAIL Please login first\n")
-                        self.mcclog.debug("Received unauthorized STOP request from {0}".format(self.address))
+                keep = self.handle(msg)
+                self.csem.release()
 
-                elif cmd == "QUIT":
-                    self.socket.write("QUIT OK Closing connection\n")
-                    self.csem.release()
+                if not keep:
                     self.stop()
                     break
 
-                else:
-                    self.socket.write("* FAIL Invalid command '{0}'\n".format(cmd))
-                    self.mcclog.debug("Received unknown command {0} from {1}".format(cmd, self.address))
-
-                # Release connection semaphore
-                self.csem.release()
+                # Stream replayed packets. Forwarded packets are interleaved
+                while self.running and not self.replaying == None:
+                    data = self.replay_chunk()
+                    if data == None:
+                        break
+                    self.csem.acquire()
+                    try:
+                        self.socket.write(data)
+                    except socket.error as e:
+                        self.mcclog.error("Failed to send packet to {0}".format(self.address))
+                        self.end_replay()
+                    finally:
+                        self.csem.release()
 
         self.socket.get_socket().close()
-        self.connlist.remove(self)
-        self.mcclog.info("Closed connection from {0}@{1} - {2} {3} connected".format(self.user, self.address, len(self.connlist), "user" if users-1 == 1 else "users"))
+        self.closed()
         self.stop()
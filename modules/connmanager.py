@@ -25,13 +25,19 @@ import select
 import os
 import ssl
 import re
+import Queue
 
 # AAUSAT3 imports
 import connection
+import reactor
+import metrics
 
 TYPE_SECURE = 1
 TYPE_INSECURE = 2
 
+# Seconds a client may take to complete the TLS handshake
+HANDSHAKE_TIMEOUT = 10
+
 # Socket placeholder used for non-TLS encrypted connections
 class socket_adapter():
     def __init__(self, socket, type):
@@ -56,17 +62,80 @@ class socket_adapter():
     def close(self):
         self.socket.close()
 
+# TLS handshake worker
+# Handshakes are run outside the accept thread, so a slow client does not
+# delay other clients
+class handshaker(threading.Thread):
+    def __init__(self, mcclog, manager):
+        threading.Thread.__init__(self, None)
+        self.mcclog = mcclog
+        self.manager = manager
+
+        # Set thread state - self.daemon is important!
+        self.daemon = True
+        self.running = True
+
+        # Start thread
+        self.start()
+
+    def run(self):
+        while self.running:
+            item = self.manager.handshakes.get()
+            if item == None:
+                break
+            (csocket, address) = item
+            try:
+                csocket.settimeout(HANDSHAKE_TIMEOUT)
+                sslsocket = self.manager.context.wrap_socket(csocket, server_side=True)
+                sslsocket.settimeout(None)
+            except Exception as e:
+                self.mcclog.warning("SSL handshake failed for {0} ({1})".format(address, str(e)))
+                csocket.close()
+                continue
+
+            self.mcclog.debug("Connection from {0} encrypted using {2} with {1} ciphers".format(address, sslsocket.cipher()[0], sslsocket.cipher()[1]))
+            self.manager.admit(socket_adapter(sslsocket, TYPE_SECURE), address)
+
 class connectionmanager(threading.Thread):
-    def __init__(self, mcclog, db, connlist, outqueue, conf):
+    def __init__(self, mcclog, db, connlist, ring, outqueue, conf):
         threading.Thread.__init__(self, None)
         self.mcclog = mcclog
         self.connlist = connlist
+        self.ring = ring
         self.outqueue = outqueue
         self.db = db
         self.port = conf.listen_port
         self.max_users = conf.max_users
         self.usetls = conf.use_tls
         self.cert = os.path.abspath(conf.certfile)
+        self.engine = conf.engine
+        self.conf = conf
+        self.lock = threading.Lock()
+
+        # Start reactor if client sockets are event driven
+        if self.engine == "reactor":
+            self.reactor = reactor.reactor(self.mcclog)
+        elif self.engine == "threads":
+            self.reactor = None
+        else:
+            raise Exception("Unknown client engine: {0}".format(self.engine))
+
+        if not conf.overflow in ("drop-oldest", "drop-newest", "disconnect"):
+            raise Exception("Unknown overflow policy: {0}".format(conf.overflow))
+
+        # Metrics
+        metrics.REGISTRY.gauge("mcc_clients", "Connected clients", lambda: len(self.connlist))
+        metrics.REGISTRY.gauge("mcc_client_backlog_packets", "Packets waiting to be forwarded to each client", self.backlog, ("client", "user", "address"))
+
+        # The TLS context is shared by all connections, so the certificate is
+        # loaded once and sessions can be resumed by reconnecting clients
+        self.workers = []
+        if self.usetls:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+            self.context.load_cert_chain(self.cert)
+            self.handshakes = Queue.Queue()
+            for i in range(conf.handshakes):
+                self.workers.append(handshaker(self.mcclog, self))
         
         # Setup server socket with IPv6 support
         self.serversocket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
@@ -95,6 +164,20 @@ class connectionmanager(threading.Thread):
         self.running = False
 
     def run(self):
+        self.accept()
+
+        # Stop handshake workers
+        for worker in self.workers:
+            self.handshakes.put(None)
+        for worker in self.workers:
+            worker.join()
+
+        # Close event driven clients
+        if not self.reactor == None:
+            self.reactor.stop()
+            self.reactor.join()
+
+    def accept(self):
         while self.running:
             try:
                 (rtr, rtw, err) = select.select([self.serversocket], [], [], 1)
@@ -112,26 +195,28 @@ class connectionmanager(threading.Thread):
                     
                     # Wrap socket in TLS if required
                     if self.usetls:
-                        try:
-                            sslsocket = ssl.wrap_socket(csocket, server_side=True, certfile=self.cert, ssl_version=ssl.PROTOCOL_TLSv1)
-                        except Exception as e:
-                            self.mcclog.warning("SSL handshake failed for {0} ({1})".format(address, str(e)))
-                            csocket.close()
-                            continue
-
-                        s = socket_adapter(sslsocket, TYPE_SECURE)
+                        self.handshakes.put((csocket, address))
                     else:
-                        s = socket_adapter(csocket, TYPE_INSECURE)
-                    
-                    # If connection and handshake succeeded
-                    if self.max_users > 0 and len(self.connlist)+1 > self.max_users:
-                        s.write("Too many users connected. Try again later\n")
-                        self.mcclog.info("Failed to accept connection from {0} - too many users connected".format(address))
-                        s.close()
-                        continue
-
-                    conn = connection.connection(self.mcclog, s, address, self.db, self.connlist, self.outqueue)
-                    self.connlist.append(conn)
-                    self.mcclog.info("Accepted connection from {0} - {1} {2} connected".format(address, len(self.connlist), "user" if len(self.connlist) == 1 else "users"))
-                    if self.usetls:
-                        self.mcclog.debug("Connection encrypted using {1} with {0} ciphers".format(sslsocket.cipher()[0], sslsocket.cipher()[1]))
+                        self.admit(socket_adapter(csocket, TYPE_INSECURE), address)
+
+    # Packets waiting to be forwarded by client
+    def backlog(self):
+        return dict([((c.id, c.user, c.address), c.backlog()) for c in list(self.connlist) if c.enabled])
+
+    # Start serving a connected client. Called after the handshake succeeded
+    def admit(self, s, address):
+        with self.lock:
+            if self.max_users > 0 and len(self.connlist)+1 > self.max_users:
+                s.write("Too many users connected. Try again later\n")
+                self.mcclog.info("Failed to accept connection from {0} - too many users connected".format(address))
+                s.close()
+                return
+
+            if self.reactor == None:
+                conn = connection.connection(self.mcclog, s, address, self.db, self.connlist, self.ring, self.outqueue, self.conf)
+                self.connlist.append(conn)
+            else:
+                conn = reactor.client(self.mcclog, self.reactor, s, address, self.db, self.connlist, self.ring, self.outqueue, self.conf)
+                self.connlist.append(conn)
+                self.reactor.add(conn)
+            self.mcclog.info("Accepted connection from {0} - {1} {2} connected".format(address, len(self.connlist), "user" if len(self.connlist) == 1 else "users"))
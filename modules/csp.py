@@ -27,9 +27,21 @@ import datetime
 import time
 import Queue
 import ctypes
+import binascii
+import collections
 
 # AAUSAT3 imports
 import pycsp
+import metrics
+import tracing
+import logqueue
+
+# Metrics
+RX_PACKETS = metrics.REGISTRY.counter("mcc_csp_rx_packets_total", "Packets received from CSP")
+RX_BYTES = metrics.REGISTRY.counter("mcc_csp_rx_bytes_total", "Payload bytes received from CSP")
+TX_PACKETS = metrics.REGISTRY.counter("mcc_csp_tx_packets_total", "Packets sent to CSP")
+TX_BYTES = metrics.REGISTRY.counter("mcc_csp_tx_bytes_total", "Payload bytes sent to CSP")
+TX_FAILED = metrics.REGISTRY.counter("mcc_csp_tx_failed_total", "Packets that could not be sent to CSP")
 
 def debug_hook(level, string):
     if debug_mcclog == None:
@@ -57,34 +69,176 @@ try:
 except:
     pass
     
-class packet():
-    def __init__(self, source, sport, dest, dport, data):
+# CSP packet. The payload is kept as a byte string
+class packet(object):
+    __slots__ = ("source", "sport", "dest", "dport", "data", "time", "prio", "trace")
+
+    def __init__(self, source, sport, dest, dport, data, prio=pycsp.CSP_PRIO_NORM):
         self.source = source
         self.sport = sport
         self.dest = dest
         self.dport = dport
         self.data = data
+        self.prio = prio
 
         # Time stores microsecons after the epoch
         self.time = int(round(time.time()*1000000))
 
+        # Latency trace timestamps. Only set when tracing is enabled
+        self.trace = None
+
     def update_time(self, time):
         self.time = time
 
     def tostring(self):
-        return "{0}:{1} {2}:{3} {4} {5}".format(self.source, self.sport, self.dest, self.dport , "".join(["{0:02x}".format(d) for d in self.data]), self.time)
+        return "{0}:{1} {2}:{3} {4} {5}".format(self.source, self.sport, self.dest, self.dport, binascii.hexlify(self.data), self.time)
 
     def debug(self):
         if not self.source == -1 and not self.sport == -1:
             return "src={0} sport={1} dst={2} dport={3} length={4}".format(self.source, self.sport, self.dest, self.dport, len(self.data))
         else:
             return "dst={0} dport={1} length={2}".format(self.dest, self.dport, len(self.data))
+
+    # Packets passed as logging arguments are formatted when written
+    __str__ = debug
             
+# Uplink lanes in order of priority
+LANES = [
+    ("critical", pycsp.CSP_PRIO_CRITICAL),
+    ("high", pycsp.CSP_PRIO_HIGH),
+    ("norm", pycsp.CSP_PRIO_NORM),
+    ("low", pycsp.CSP_PRIO_LOW),
+]
+
+# Uplink scheduler
+# Outgoing packets are queued in one lane per CSP priority. Lanes are served
+# by weighted round robin, so timing critical packets do not wait behind bulk
+# traffic and a busy lane cannot starve the others. Provides the put() and
+# get() interface of Queue.Queue.
+# Control packets bypass the lanes. Only the latest packet for each control
+# key is kept, and these are sent before any lane is served
+class scheduler():
+    def __init__(self, weights, size):
+        if not len(weights) == len(LANES) or min(weights) < 1:
+            raise Exception("Expected {0} positive lane weights, got {1}".format(len(LANES), weights))
+
+        self.size = size
+        self.cond = threading.Condition()
+        self.lanes = {}
+        self.weights = {}
+        self.credits = {}
+        self.latency = {}
+        for ((name, prio), weight) in zip(LANES, weights):
+            self.lanes[prio] = collections.deque()
+            self.weights[prio] = weight
+            self.credits[prio] = weight
+            self.latency[prio] = {"packets": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+
+        self.controls = collections.OrderedDict()
+        self.latency["control"] = {"packets": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+
+        metrics.REGISTRY.gauge("mcc_uplink_queued_packets", "Packets waiting in each uplink lane", lambda: self.lane_stats("queued"), ("lane",))
+        metrics.REGISTRY.gauge("mcc_uplink_sent_total", "Packets taken from each uplink lane", lambda: self.lane_stats("packets"), ("lane",), kind="counter")
+        metrics.REGISTRY.gauge("mcc_uplink_latency_avg_seconds", "Average time packets waited in each uplink lane", lambda: self.lane_stats("avg"), ("lane",))
+        metrics.REGISTRY.gauge("mcc_uplink_latency_max_seconds", "Longest time a packet waited in each uplink lane", lambda: self.lane_stats("max"), ("lane",))
+
+    def qsize(self):
+        with self.cond:
+            return sum([len(lane) for lane in self.lanes.values()]) + len(self.controls)
+
+    # Queue a control packet. Returns True if it replaced a packet not yet sent
+    def put_control(self, key, packet):
+        with self.cond:
+            replaced = not self.controls.pop(key, None) == None
+            self.controls[key] = (time.time(), packet)
+            self.cond.notify_all()
+            return replaced
+
+    def put(self, packet, block=True, timeout=None):
+        with self.cond:
+            lane = self.lanes[packet.prio]
+            if timeout != None:
+                endtime = time.time() + timeout
+            while len(lane) >= self.size:
+                if not block:
+                    raise Queue.Full
+                elif timeout == None:
+                    self.cond.wait()
+                else:
+                    remaining = endtime - time.time()
+                    if remaining <= 0.0:
+                        raise Queue.Full
+                    self.cond.wait(remaining)
+            lane.append((time.time(), packet))
+            self.cond.notify_all()
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if timeout != None:
+                endtime = time.time() + timeout
+            while not self.controls and not any(self.lanes.values()):
+                if not block:
+                    raise Queue.Empty
+                elif timeout == None:
+                    self.cond.wait()
+                else:
+                    remaining = endtime - time.time()
+                    if remaining <= 0.0:
+                        raise Queue.Empty
+                    self.cond.wait(remaining)
+
+            if self.controls:
+                # Control packets go first
+                prio = "control"
+                (key, (queued, packet)) = self.controls.popitem(last=False)
+            else:
+                # Serve the highest priority lane with credit left. When no
+                # waiting lane has credit, a new round is started
+                prio = None
+                while prio == None:
+                    for (name, p) in LANES:
+                        if self.lanes[p] and self.credits[p] > 0:
+                            prio = p
+                            break
+                    else:
+                        self.credits = dict(self.weights)
+                self.credits[prio] -= 1
+
+                (queued, packet) = self.lanes[prio].popleft()
+                self.cond.notify_all()
+
+            # Time spent waiting in the lane
+            delay = time.time() - queued
+            stats = self.latency[prio]
+            stats["packets"] += 1
+            stats["total"] += delay
+            stats["last"] = delay
+            stats["max"] = max(stats["max"], delay)
+            return packet
+
+    def stats(self):
+        with self.cond:
+            stats = {}
+            for (name, prio) in LANES:
+                lane = dict(self.latency[prio])
+                lane["queued"] = len(self.lanes[prio])
+                lane["avg"] = lane["total"] / lane["packets"] if lane["packets"] else 0.0
+                stats[name] = lane
+            control = dict(self.latency["control"])
+            control["queued"] = len(self.controls)
+            control["avg"] = control["total"] / control["packets"] if control["packets"] else 0.0
+            stats["control"] = control
+            return stats
+
+    # One statistic of every lane by (lane,) label
+    def lane_stats(self, key):
+        return dict([((name,), lane[key]) for (name, lane) in self.stats().items()])
+
 class csp():
-    def __init__(self, mcclog, dbmanager, inqueue, outqueue, conf):
+    def __init__(self, mcclog, dblog, inqueue, outqueue, conf):
         global debug_mcclog
 	self.mcclog = mcclog
-        self.dbmanager = dbmanager
+        self.dblog = dblog
         self.inqueue = inqueue
         self.outqueue = outqueue
         self.csp_host = conf.csp_host
@@ -100,10 +254,11 @@ class csp():
         pycsp.csp_can_init(1, ctypes.byref(can_conf), ctypes.sizeof(can_conf))
         pycsp.csp_route_set(pycsp.CSP_DEFAULT_ROUTE, pycsp.csp_if_can, pycsp.CSP_NODE_MAC)
         pycsp.csp_route_start_task(0, 1) # Args ignored on posix
+        metrics.REGISTRY.gauge("mcc_csp_buffers_free", "Free CSP packet buffers", pycsp.csp_buffer_remaining)
         
         # Start processing threads
-        self.writer = writer(self.mcclog, self, self.outqueue, self.dbmanager, conf)
-        self.reader = reader(self.mcclog, self, self.inqueue, self.dbmanager)
+        self.writer = writer(self.mcclog, self, self.outqueue, self.dblog, conf)
+        self.reader = reader(self.mcclog, self, self.inqueue, self.dblog)
         self.service = service(self.mcclog)
                 
     def __del__(self):
@@ -116,7 +271,80 @@ class csp():
         self.writer.join()
         self.reader.join()
         self.service.join()
-        
+
+        stats = self.writer.cache.stats()
+        self.mcclog.debug("CSP connection cache: {0} hits, {1} misses, {2} evicted, {3} failed".format(stats["hits"], stats["misses"], stats["evicted"], stats["failed"]))
+
+# Cache of open outgoing CSP connections keyed by (prio, dest, dport)
+# Connections idle for more than timeout seconds are closed
+class conncache():
+    def __init__(self, mcclog, timeout, size):
+        self.mcclog = mcclog
+        self.timeout = timeout
+        self.size = size
+        self.conns = {}
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.failed = 0
+        metrics.REGISTRY.gauge("mcc_csp_conns_open", "Open outgoing CSP connections", lambda: len(self.conns))
+        metrics.REGISTRY.gauge("mcc_csp_conn_hits_total", "Packets sent on a cached CSP connection", lambda: self.hits, kind="counter")
+        metrics.REGISTRY.gauge("mcc_csp_conn_misses_total", "Outgoing CSP connections opened", lambda: self.misses, kind="counter")
+        metrics.REGISTRY.gauge("mcc_csp_conn_evicted_total", "Outgoing CSP connections closed when idle or over the limit", lambda: self.evicted, kind="counter")
+        metrics.REGISTRY.gauge("mcc_csp_conn_failed_total", "Outgoing CSP connections closed after a failed send", lambda: self.failed, kind="counter")
+
+    def stats(self):
+        return {
+            "open": len(self.conns),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "failed": self.failed,
+        }
+
+    # Get open connection. Raises pycsp.NullPointerException if connect fails
+    def get(self, prio, dest, dport):
+        key = (prio, dest, dport)
+        entry = self.conns.get(key)
+        if not entry == None:
+            self.hits += 1
+            entry[1] = time.time()
+            return entry[0]
+
+        self.misses += 1
+
+        # Close the least recently used connection to stay within the limit
+        if len(self.conns) >= self.size:
+            oldest = min(self.conns, key=lambda k: self.conns[k][1])
+            self.evicted += 1
+            pycsp.csp_close(self.conns.pop(oldest)[0])
+
+        conn = pycsp.csp_connect(prio, dest, dport, 1000, 0)
+        self.conns[key] = [conn, time.time()]
+        return conn
+
+    # Close a connection that failed to send
+    def invalidate(self, prio, dest, dport):
+        entry = self.conns.pop((prio, dest, dport), None)
+        if not entry == None:
+            self.failed += 1
+            pycsp.csp_close(entry[0])
+
+    def expire(self):
+        now = time.time()
+        for (key, (conn, used)) in self.conns.items():
+            if now - used > self.timeout:
+                del self.conns[key]
+                self.evicted += 1
+                pycsp.csp_close(conn)
+
+    def close(self):
+        for (conn, used) in self.conns.values():
+            pycsp.csp_close(conn)
+        self.conns = {}
+
 class service(threading.Thread):
     def __init__(self, mcclog):
         self.mcclog = mcclog
@@ -169,11 +397,12 @@ class service(threading.Thread):
                 pycsp.csp_close(conn)
 
 class writer(threading.Thread):
-    def __init__(self, mcclog, canhandle, outq, dbmanager, conf):
+    def __init__(self, mcclog, canhandle, outq, dblog, conf):
         self.mcclog = mcclog
         self.outq = outq
-        self.db = dbmanager.get_connection()
+        self.dblog = dblog
         self.csp_host = conf.csp_host
+        self.cache = conncache(self.mcclog, conf.csp_conntimeout, conf.csp_maxconns)
         
         # Start thread
         threading.Thread.__init__(self, None)
@@ -188,15 +417,38 @@ class writer(threading.Thread):
     def stop(self):
         self.running = False
     
+    def send(self, packet, buf_packet):
+        # Send using a cached connection. If that fails, the connection may
+        # be stale, so it is rebuilt and the send is retried once
+        for attempt in range(2):
+            try:
+                conn = self.cache.get(packet.prio, packet.dest, packet.dport)
+            except pycsp.NullPointerException:
+                self.mcclog.warning("Failed to connect to {0}:{1}".format(packet.dest, packet.dport))
+                return False
+
+            try:
+                pycsp.csp_send(conn, buf_packet, 1000)
+            except:
+                self.cache.invalidate(packet.prio, packet.dest, packet.dport)
+            else:
+                return True
+
+        self.mcclog.warning("Timeout while sending to {0}:{1}".format(packet.dest, packet.dport))
+        return False
+
     def run(self):
         while self.running:
+            # Close idle connections
+            self.cache.expire()
+
             try:
                 # Read next outgoing CSP packet
                 packet = self.outq.get(True, 0.1)
             except:
                 pass
             else:
-                self.mcclog.debug("Sending CSP packet: {0}".format(packet.debug()))
+                self.mcclog.debug("Sending CSP packet: %s", packet, extra=logqueue.PACKET)
                 
                 # Get length of data
                 plength = len(packet.data)
@@ -206,42 +458,30 @@ class writer(threading.Thread):
                     buf_packet = ctypes.cast(pycsp.csp_buffer_get(plength), ctypes.POINTER(pycsp.csp_packet_t))
                 except pycsp.NullPointerException:
                     self.mcclog.warning("Failed to get CSP packet buffer")
+                    TX_FAILED.inc()
                     continue
                 
-                buf_packet.contents.data = tuple(packet.data)
+                ctypes.memmove(buf_packet.contents.data, packet.data, plength)
                 buf_packet.contents.length = plength
                 
-                # Connect
-                try:
-                    conn = pycsp.csp_connect(pycsp.CSP_PRIO_NORM, packet.dest, packet.dport, 1000, 0)
-                except pycsp.NullPointerException:
-                    pycsp.csp_buffer_free(buf_packet)
-                    self.mcclog.warning("Failed to connect to {0}:{1}".format(packet.dest, packet.dport))
-                    continue
-                
                 # Send packet
-                try:
-                    pycsp.csp_send(conn, buf_packet, 1000)
-                except:
+                if not self.send(packet, buf_packet):
                     pycsp.csp_buffer_free(buf_packet)
-                    pycsp.csp_close(conn)
-                    self.mcclog.warning("Timeout while sending to {0}:{1}".format(packet.dest, packet.dport))
+                    TX_FAILED.inc()
                     continue
-                    
-                # Close connection
-                pycsp.csp_close(conn)
+                TX_PACKETS.inc()
+                TX_BYTES.inc(plength)
                 
                 # Log frame to database
-                try:
-                    self.db.log_data(packet, 'OUT')
-                except Exception as e:
-                    self.mcclog.warning("Failed to log data: {0}".format(e))
+                self.dblog.log(packet, 'OUT')
+
+        self.cache.close()
 
 class reader(threading.Thread):
-    def __init__(self, mcclog, canhandle, inq, dbmanager):
+    def __init__(self, mcclog, canhandle, inq, dblog):
         self.mcclog = mcclog
         self.inq = inq
-        self.db = dbmanager.get_connection()
+        self.dblog = dblog
 
         # Enable CSP promiscuous mode
         pycsp.csp_promisc_enable(20)
@@ -266,22 +506,24 @@ class reader(threading.Thread):
                 ppacket = pycsp.csp_promisc_read(1000)
             except pycsp.NullPointerException:
                 continue
+            received = time.time()
             
             # Create new packet object  
             p = packet(ppacket.contents.id.src, 
                 ppacket.contents.id.sport, 
                 ppacket.contents.id.dst, 
                 ppacket.contents.id.dport, 
-                ppacket.contents.data[0:ppacket.contents.length])
+                ctypes.string_at(ctypes.addressof(ppacket.contents.data), ppacket.contents.length))
 
             # Free buffer
             pycsp.csp_buffer_free(ppacket)
+            RX_PACKETS.inc()
+            RX_BYTES.inc(len(p.data))
+            tracing.start(p, received)
             
             # Log and add CSP packet to incoming queue
+            tracing.stamp(p)
             self.inq.put(p)
-            self.mcclog.debug("Received CSP packet: {0}".format(p.debug()))
-            try:
-                self.db.log_data(p, 'IN')
-            except Exception as e:
-                self.mcclog.warning("Failed to log data: {0}".format(e))
+            self.mcclog.debug("Received CSP packet: %s", p, extra=logqueue.PACKET)
+            self.dblog.log(p, 'IN')
 
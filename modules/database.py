@@ -20,108 +20,850 @@
 
 # Python imports
 import sys
+import os
 import time
-import re
+import datetime
+import threading
+import Queue
+import binascii
+import gzip
+import csv
+import contextlib
 
 # AAUSAT3 imports
 import csp
+import metrics
 
 # This could be ported to SQLalchemy
 
+# Columns of the data table in row order
+COLUMNS = "pid,time,dir,source,sport,dest,dport,data"
+
+# Number of packets fetched per chunk when replaying
+REPLAY_CHUNK = 500
+
+# Replay key (time, pid) before all packets
+FIRST = (-1, -1)
+
+# Current database schema version
+# 1: Payload stored as hex encoded text, no indexes
+# 2: Payload stored as binary, indexes on (dir, time) and (source, sport, time)
+# 3: Catalog of time partitioned data tables
+SCHEMA_VERSION = 3
+
+# Number of rows converted per commit when migrating
+MIGRATE_CHUNK = 10000
+
+# Attempts to log a group of packets, and the delay before the first retry.
+# The delay doubles for every retry
+LOG_ATTEMPTS = 4
+LOG_RETRY_DELAY = 0.1
+
+# Indexes on data tables
+INDEXES = [
+    "create index {0}_dir_time on {0} (dir, time)",
+    "create index {0}_source_sport_time on {0} (source, sport, time)",
+]
+
+# Catalog of partitions. Each partition holds packets logged in [start, stop)
+PARTITIONS_TABLE = "create table partitions (name varchar(32) primary key, start bigint not null, stop bigint not null)"
+
+# Supported partitioning modes
+PARTITIONING = ["none", "day", "week"]
+
+# Length of a day in packet time units (microseconds)
+DAY = 86400 * 1000000
+
+# Number of rows copied per query when archiving a partition
+ARCHIVE_CHUNK = 10000
+
+# Seconds between checks for expired partitions
+ARCHIVE_INTERVAL = 3600
+
+# Seconds to wait for a pooled connection before giving up
+POOL_TIMEOUT = 10
+
+# Pooled connections idle for more than this many seconds are tested before use
+POOL_CHECK = 30
+
+# Return (name, start, stop) of the partition holding packets logged at time
+def partition_range(mode, time):
+    days = time // DAY
+    if mode == "week":
+        # Weeks start on mondays. 1970-01-01 was a thursday
+        days -= (days + 3) % 7
+        length = 7
+    else:
+        length = 1
+    start = days * DAY
+    name = "data_{0}".format(datetime.datetime.utcfromtimestamp(days * 86400).strftime("%Y%m%d"))
+    return (name, start, start + length * DAY)
+
 # Database connection base class
 class dbconn():
     conn = None
 
-    def __init__(self, mcclog, placeholder):
+    # Exceptions raised by the database module
+    error = Exception
+
+    def __init__(self, mcclog, conf, placeholder):
         self.mcclog = mcclog
         self.placeholder = placeholder
+        self.partition = conf.db_partition
+
+        # Partition receiving the most recently logged packets
+        self.current = None
 
     def __del__(self):
+        self.close()
+
+    def close(self):
         if not self.conn == None:
             self.conn.close()
+            self.conn = None
 
-    def validate_user(self, user, password):
-        self.cur.execute("select * from users where username={0} and password={0}".format(self.placeholder), (user, password))
-        self.conn.commit()
-        if len(self.cur.fetchall()) == 1:
-            return True
-        else:
+    # Abandon the current transaction. Returns False if the connection failed
+    def rollback(self):
+        try:
+            self.conn.rollback()
+        except Exception:
             return False
+        return True
+
+    # Test if the connection is still usable
+    def ping(self):
+        try:
+            self.cur.execute("select 1")
+            self.cur.fetchall()
+            self.conn.commit()
+        except Exception:
+            return False
+        return True
+
+    # Return a dict of password hashes by username
+    def users(self):
+        self.cur.execute("select username,password from users")
+        users = dict(self.cur.fetchall())
+        self.conn.commit()
+        return users
 
     def log_data(self, packet, dir):
-        query = "insert into data (time,dir,source,dest,sport,dport,data) values ({0},{0},{0},{0},{0},{0},{0})".format(self.placeholder)
-        fields = (packet.time, dir, packet.source, packet.dest, packet.sport, packet.dport, "".join(["{0:02x}".format(p) for p in packet.data])) 
-        self.cur.execute(query, fields)
+        self.log_batch([(packet, dir)])
+
+    def log_batch(self, entries):
+        # Insert a list of (packet, dir) tuples using a single commit
+        query = "insert into {1} (time,dir,source,dest,sport,dport,data) values ({0},{0},{0},{0},{0},{0},{0})"
+        try:
+            tables = {}
+            for (packet, dir) in entries:
+                rows = tables.setdefault(self.table(packet.time), [])
+                rows.append((packet.time, dir, packet.source, packet.dest, packet.sport, packet.dport, self.binary(packet.data)))
+            for (table, rows) in tables.items():
+                self.cur.executemany(query.format(self.placeholder, table), rows)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+
+    # Name of the data table for packets logged at time
+    def table(self, time):
+        if self.partition == "none":
+            return "data"
+        if self.current == None or not self.current[1] <= time < self.current[2]:
+            self.current = self.create_partition(*partition_range(self.partition, time))
+        return self.current[0]
+
+    def create_partition(self, name, start, stop):
+        self.cur.execute("select name from partitions where name={0}".format(self.placeholder), (name,))
+        if not self.cur.fetchall():
+            self.cur.execute(self.DATA_TABLE.format(name))
+            for index in INDEXES:
+                self.cur.execute(index.format(name))
+            self.cur.execute("insert into partitions (name,start,stop) values ({0},{0},{0})".format(self.placeholder), (name, start, stop))
+            self.mcclog.info("Created partition {0}".format(name))
         self.conn.commit()
+        return (name, start, stop)
 
-    def replay(self, num):
-        lst = []
-        query = "select * from (select * from data where dir='IN' order by time desc limit {0}) as tmp order by time asc;".format(self.placeholder)
-        self.cur.execute(query, (num,))
+    # Data tables that may hold packets logged between start and stop, oldest
+    # first. The unpartitioned data table is always included
+    def partitions(self, start=0, stop=sys.maxint):
+        self.cur.execute("select name from partitions where stop > {0} and start <= {0} order by start asc".format(self.placeholder), (start, stop))
+        tables = ["data"] + [row[0] for row in self.cur.fetchall()]
         self.conn.commit()
-        for row in self.cur.fetchall():
-            (pid, time, dir, source, sport, dest, dport, data) = row
-            if data == "":
-                t = ()
+        return tables
+
+    # Partitions holding only packets logged before cutoff
+    def expired(self, cutoff):
+        self.cur.execute("select name from partitions where stop <= {0} order by start asc".format(self.placeholder), (cutoff,))
+        names = [row[0] for row in self.cur.fetchall()]
+        self.conn.commit()
+        return names
+
+    # Copy a partition to a compressed CSV file and drop it. Rows are read in
+    # short transactions, so the database logger is not locked out
+    def archive(self, name, path):
+        select = "select {1} from {2} where pid > {0} order by pid asc limit {0}".format(self.placeholder, COLUMNS, name)
+        last = -1
+        count = 0
+        try:
+            out = gzip.open(path + ".part", "wb")
+            try:
+                writer = csv.writer(out)
+                writer.writerow(COLUMNS.split(","))
+                while True:
+                    self.cur.execute(select, (last, ARCHIVE_CHUNK))
+                    rows = self.cur.fetchall()
+                    self.conn.commit()
+                    if not rows:
+                        break
+                    writer.writerows([row[:7] + (binascii.hexlify(row[7]),) for row in rows])
+                    last = rows[-1][0]
+                    count += len(rows)
+            finally:
+                out.close()
+            os.rename(path + ".part", path)
+
+            self.cur.execute("delete from partitions where name={0}".format(self.placeholder), (name,))
+            self.cur.execute("drop table {0}".format(name))
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        return count
+
+    # Wrap a payload for insertion into a binary column
+    def binary(self, data):
+        return data
+
+    def packet(self, row):
+        (pid, time, dir, source, sport, dest, dport, data) = row
+        packet = csp.packet(source, sport, dest, dport, str(data))
+        packet.update_time(time)
+        return packet
+
+    def count(self, query, args):
+        self.cur.execute(query, args)
+        count = self.cur.fetchone()[0]
+        self.conn.commit()
+        return count
+
+    # Read at most num rows from table matching where, ordered by (time, pid)
+    # and following key. Each page is a separate short transaction
+    # Read at most num rows after key up to and including stop
+    def page(self, table, where, args, key, stop, num):
+        query = "select {1} from {2} where {3} and (time > {0} or (time = {0} and pid > {0})) and {4} order by time asc, pid asc limit {0}".format(self.placeholder, COLUMNS, table, where, self.upto())
+        self.cur.execute(query, args + (key[0], key[0], key[1]) + (stop[0], stop[0], stop[1], num))
+        rows = self.cur.fetchall()
+        self.conn.commit()
+        return rows
+
+    # Condition on rows up to and including a (time, pid) key
+    def upto(self):
+        return "(time < {0} or (time = {0} and pid <= {0}))".format(self.placeholder)
+
+    # Newest (time, pid) key of the rows matching where, or None
+    def last_key(self, table, where, args):
+        self.cur.execute("select time,pid from {0} where {1} order by time desc, pid desc limit 1".format(table, where), args)
+        row = self.cur.fetchone()
+        self.conn.commit()
+        return row
+
+    # Count the rows matching where up to and including stop
+    def count_upto(self, table, where, args, stop):
+        return self.count("select count(*) from {0} where {1} and {2}".format(table, where, self.upto()), args + (stop[0], stop[0], stop[1]))
+
+    def table_exists(self, table):
+        try:
+            self.cur.execute("select 1 from {0} limit 1".format(table))
+            self.cur.fetchall()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            return False
+        return True
+
+    def schema_version(self):
+        try:
+            self.cur.execute("select version from schema_version")
+            version = self.cur.fetchone()[0]
+            self.conn.commit()
+        except Exception:
+            # Databases created before versioning
+            self.conn.rollback()
+            version = 1
+        return version
+
+    # Migrate the database to the current schema version
+    def migrate(self):
+        version = self.schema_version()
+        if version >= SCHEMA_VERSION:
+            self.mcclog.info("Database schema is up to date (version {0})".format(version))
+            return
+
+        self.mcclog.info("Migrating database schema from version {0} to {1}".format(version, SCHEMA_VERSION))
+        if version < 2:
+            self.migrate_binary()
+        if version < 3:
+            self.migrate_partitions()
+        self.mcclog.info("Database migrated to schema version {0}".format(SCHEMA_VERSION))
+
+    # Convert hex encoded payloads to binary. Rows are copied to a new table
+    # in chunks, so an interrupted migration can be resumed
+    def migrate_binary(self):
+        if self.table_exists("data_old"):
+            # Tables were swapped but the migration was not completed
+            self.mcclog.info("Resuming migration after table swap")
+            self.begin_schema()
+        else:
+            if self.table_exists("data_new") and not self.table_exists("data"):
+                # Old table was dropped but the new one not renamed
+                self.mcclog.info("Resuming migration at table swap")
             else:
-                t = tuple([int(d, 16) for d in re.findall("[0-9a-f]{2}", data)])
-            packet = csp.packet(source, sport, dest, dport, t)
-            packet.update_time(time)
-            lst.append(packet)
-        return lst
+                self.copy_binary()
+
+            # Replace old table
+            self.begin_schema()
+            self.swap_binary()
+
+        # Create indexes and record the version together with the swap
+        for index in INDEXES:
+            self.cur.execute(index.format("data"))
+        self.reset_sequence("data")
+        self.cur.execute("create table schema_version (version integer not null)")
+        self.cur.execute("insert into schema_version (version) values ({0})".format(self.placeholder), (2,))
+        self.cur.execute("drop table if exists data_old")
+        self.commit_schema()
+
+    def copy_binary(self):
+        if self.table_exists("data_new"):
+            self.cur.execute("select max(pid) from data_new")
+            last = self.cur.fetchone()[0] or -1
+            self.conn.commit()
+            self.mcclog.info("Resuming migration after row {0}".format(last))
+        else:
+            self.cur.execute(self.DATA_TABLE.format("data_new"))
+            self.conn.commit()
+            last = -1
+
+        select = "select {1} from data where pid > {0} order by pid asc limit {0}".format(self.placeholder, COLUMNS)
+        insert = "insert into data_new ({1}) values ({0},{0},{0},{0},{0},{0},{0},{0})".format(self.placeholder, COLUMNS)
+        copied = 0
+        while True:
+            self.cur.execute(select, (last, MIGRATE_CHUNK))
+            rows = self.cur.fetchall()
+            if not rows:
+                break
+            self.cur.executemany(insert, [row[:7] + (self.binary(binascii.unhexlify(row[7])),) for row in rows])
+            self.conn.commit()
+            last = rows[-1][0]
+            copied += len(rows)
+            self.mcclog.info("Migrated {0} rows".format(copied))
+
+    def swap_binary(self):
+        self.cur.execute("drop table if exists data")
+        self.cur.execute("alter table data_new rename to data")
+
+    def migrate_partitions(self):
+        self.cur.execute(PARTITIONS_TABLE)
+        self.cur.execute("update schema_version set version={0}".format(self.placeholder), (3,))
+        self.conn.commit()
+
+    # Continue primary key numbering after rows copied with explicit keys
+    def reset_sequence(self, table):
+        pass
+
+    # Schema changes between these are committed at once
+    def begin_schema(self):
+        pass
+
+    def commit_schema(self):
+        self.conn.commit()
+
+    # Replay queries return a replay of the matching packets. Each table is
+    # read up to its newest matching row when counted, so packets logged
+    # during the replay are not sent
+    # Only the newest partitions holding the last num packets are queried
+    def replay(self, num, chunk=REPLAY_CHUNK):
+        num = int(num)
+        count = 0
+        queries = []
+        for table in reversed(self.partitions()):
+            if count >= num:
+                break
+            stop = self.last_key(table, "dir='IN'", ())
+            if stop == None:
+                continue
+            found = self.count_upto(table, "dir='IN'", (), stop)
+            if count + found > num:
+                # Start at the oldest of the packets still needed
+                self.cur.execute("select time,pid from {1} where dir='IN' and {2} order by time desc, pid desc limit 1 offset {0}".format(self.placeholder, table, self.upto()), (stop[0], stop[0], stop[1], num - count - 1))
+                (time, pid) = self.cur.fetchone()
+                self.conn.commit()
+                queries.insert(0, (table, "dir='IN'", (), (time, pid - 1), stop))
+                count = num
+            else:
+                queries.insert(0, (table, "dir='IN'", (), FIRST, stop))
+                count += found
+        return replay(count, queries, chunk)
+
+    def replay_range(self, start, stop, chunk=REPLAY_CHUNK):
+        return self.replay_where("dir='IN' and time >= {0} and time <= {0}".format(self.placeholder), (start, stop), self.partitions(start, stop), chunk)
+
+    def replay_since(self, start, chunk=REPLAY_CHUNK):
+        return self.replay_where("dir='IN' and time >= {0}".format(self.placeholder), (start,), self.partitions(start), chunk)
+
+    def replay_where(self, where, args, tables, chunk):
+        count = 0
+        queries = []
+        for table in tables:
+            stop = self.last_key(table, where, args)
+            if not stop == None:
+                count += self.count_upto(table, where, args, stop)
+                queries.append((table, where, args, FIRST, stop))
+        return replay(count, queries, chunk)
+
+# Packets to replay, read in pages ordered by (time, pid). No statement is
+# kept open between chunks, so a slow client does not hold locks that stop
+# the database logger from committing
+class replay():
+    def __init__(self, count, queries, chunk):
+        self.count = count
+        self.chunk = chunk
+
+        # Remaining (table, where, args, last key read, last key) in order
+        self.queries = queries
+
+    # Read the next chunk of packets using db. Returns None when done
+    def fetch(self, db):
+        while self.queries:
+            (table, where, args, key, stop) = self.queries[0]
+            rows = db.page(table, where, args, key, stop, self.chunk)
+            if len(rows) < self.chunk:
+                self.queries.pop(0)
+            else:
+                self.queries[0] = (table, where, args, (rows[-1][1], rows[-1][0]), stop)
+            if rows:
+                return [db.packet(row) for row in rows]
+        return None
 
 # SQLite database class
 class sqlitedb(dbconn):
+    DATA_TABLE = "create table {0} (pid integer primary key autoincrement not null, time integer not null, dir text not null, source integer not null, sport integer not null, dest integer not null, dport integer not null, data blob not null)"
 
     def __init__(self, mcclog, conf):
         # Delayed import as sqlite3 should not be required if SQLite is not used
         import sqlite3
 
-        dbconn.__init__(self, mcclog, "?")
+        dbconn.__init__(self, mcclog, conf, "?")
+        self.error = sqlite3.Error
         self.conn = sqlite3.connect(conf.db_file, check_same_thread=False)
         self.cur = self.conn.cursor()
 
+    def binary(self, data):
+        return buffer(data)
+
+    # pysqlite commits before each DDL statement, so schema changes are made
+    # in an explicit transaction
+    def begin_schema(self):
+        self.conn.isolation_level = None
+        self.cur.execute("begin")
+
+    def commit_schema(self):
+        self.cur.execute("commit")
+        self.conn.isolation_level = ""
+
 # MySQL database class
 class mysqldb(dbconn):
+    DATA_TABLE = "create table {0} (pid integer not null auto_increment primary key, time bigint not null, dir varchar(3) not null, source integer not null, sport integer not null, dest integer not null, dport integer not null, data blob not null)"
 
     def __init__(self, mcclog, conf):
         # Delayed import as MySQLdb should not be required if MySQL is not used
         import MySQLdb
 
-        dbconn.__init__(self, mcclog, "%s")
+        dbconn.__init__(self, mcclog, conf, "%s")
+        self.error = MySQLdb.Error
         self.conn = MySQLdb.connect(host=conf.db_host, user=conf.db_user, passwd=conf.db_pass, db=conf.db_name)
         self.cur = self.conn.cursor()
 
+    # DDL commits implicitly in MySQL, so both tables are renamed in one
+    # statement. The old table is dropped once the migration is recorded
+    def swap_binary(self):
+        if self.table_exists("data"):
+            self.cur.execute("rename table data to data_old, data_new to data")
+        else:
+            self.cur.execute("rename table data_new to data")
+
 # PostgreSQL database class
 class postgresqldb(dbconn):
+    DATA_TABLE = "create table {0} (pid serial primary key, time bigint not null, dir varchar(3) not null, source integer not null, sport integer not null, dest integer not null, dport integer not null, data bytea not null)"
 
     def __init__(self, mcclog, conf):
         # Delayed import as psycopg2 should not be required if PostgreSQL is not used
         import psycopg2
         import psycopg2.extras
         
-        dbconn.__init__(self, mcclog, "%s")
+        dbconn.__init__(self, mcclog, conf, "%s")
+        self.error = psycopg2.Error
         self.conn = psycopg2.connect("dbname='{0}' user='{1}' host='{2}' password='{3}' sslmode='require'".format(conf.db_name, conf.db_user, conf.db_host, conf.db_pass))
         self.cur = self.conn.cursor()
 
+    def binary(self, data):
+        import psycopg2
+        return psycopg2.Binary(data)
+
+    def reset_sequence(self, table):
+        self.cur.execute("select setval(pg_get_serial_sequence('{0}', 'pid'), coalesce(max(pid), 0) + 1, false) from {0}".format(table))
+
+# Asynchronous packet logger
+# The CSP threads only queue packets here. Rows are written by a separate
+# thread in groups of up to batchsize packets, or batchtime milliseconds
+# after the first packet of a group was queued, using one commit per group.
+class dblogger(threading.Thread):
+    def __init__(self, mcclog, dbmanager, conf):
+        threading.Thread.__init__(self, None)
+        self.mcclog = mcclog
+        self.db = dbmanager.get_connection()
+        self.batchsize = conf.db_batchsize
+        self.batchtime = conf.db_batchtime / 1000.0
+        self.queue = Queue.Queue(conf.db_queuesize)
+
+        # Statistics
+        self.lock = threading.Lock()
+        self.logged = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_batch = 0
+        self.max_batch = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+        # Metrics
+        metrics.REGISTRY.gauge("mcc_db_queue_depth", "Packets waiting to be logged", self.queue.qsize)
+        metrics.REGISTRY.gauge("mcc_db_logged_total", "Packets logged to the database", lambda: self.stats()["logged"], kind="counter")
+        metrics.REGISTRY.gauge("mcc_db_dropped_total", "Packets dropped because the log queue was full", lambda: self.stats()["dropped"], kind="counter")
+        metrics.REGISTRY.gauge("mcc_db_failed_total", "Packets that could not be logged", lambda: self.stats()["failed"], kind="counter")
+        metrics.REGISTRY.gauge("mcc_db_commits_total", "Database log commits", lambda: self.stats()["flushes"], kind="counter")
+        metrics.REGISTRY.gauge("mcc_db_commit_seconds", "Duration of the last database log commit", lambda: self.stats()["last_latency"])
+        metrics.REGISTRY.gauge("mcc_db_commit_max_seconds", "Longest database log commit", lambda: self.stats()["max_latency"])
+
+        # Set thread state - self.daemon is important!
+        self.daemon = True
+        self.running = True
+
+        # Start thread
+        self.start()
+
+    def stop(self):
+        # Queued packets are flushed before the thread exits
+        self.running = False
+
+    def log(self, packet, dir):
+        try:
+            self.queue.put_nowait((packet, dir))
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+            self.mcclog.warning("Database log queue full - dropped packet: {0}".format(packet.debug()))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "logged": self.logged,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "flushes": self.flushes,
+                "last_batch": self.last_batch,
+                "max_batch": self.max_batch,
+                "avg_batch": float(self.logged) / self.flushes if self.flushes else 0.0,
+                "last_latency": self.last_latency,
+                "max_latency": self.max_latency,
+                "avg_latency": self.total_latency / self.flushes if self.flushes else 0.0,
+            }
+
+    def flush(self, batch):
+        for attempt in range(LOG_ATTEMPTS):
+            try:
+                start = time.time()
+                self.db.log_batch(batch)
+                break
+            except Exception as e:
+                # Transient errors such as a locked database are retried
+                if attempt < LOG_ATTEMPTS - 1:
+                    self.mcclog.debug("Retrying to log {0} packets: {1}".format(len(batch), e))
+                    time.sleep(LOG_RETRY_DELAY * 2 ** attempt)
+        else:
+            with self.lock:
+                self.failed += len(batch)
+            self.mcclog.warning("Failed to log {0} packets: {1}".format(len(batch), e))
+            return
+
+        latency = time.time() - start
+        with self.lock:
+            self.logged += len(batch)
+            self.flushes += 1
+            self.last_batch = len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+
+    def run(self):
+        batch = []
+        deadline = 0
+        while True:
+            # Wait for the first packet of a group, or until the group is due
+            if batch:
+                timeout = max(0.0, deadline - time.time())
+            else:
+                timeout = 0.1
+            try:
+                batch.append(self.queue.get(True, timeout))
+            except Queue.Empty:
+                pass
+            else:
+                if len(batch) == 1:
+                    deadline = time.time() + self.batchtime
+
+            # Drain the queue when stopping
+            draining = not self.running and self.queue.empty()
+            if batch and (len(batch) >= self.batchsize or time.time() >= deadline or draining):
+                self.flush(batch)
+                batch = []
+
+            if draining and not batch:
+                break
+
+# Partition archiver
+# Partitions holding only packets older than the retention period are copied
+# to compressed files in the archive directory and dropped from the database
+class archiver(threading.Thread):
+    def __init__(self, mcclog, dbmanager, conf):
+        threading.Thread.__init__(self, None)
+        self.mcclog = mcclog
+        self.dbmanager = dbmanager
+        self.retention = conf.db_retention
+        self.directory = conf.db_archive
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Set thread state - self.daemon is important!
+        self.daemon = True
+        self.running = True
+
+        # Start thread
+        self.start()
+
+    def stop(self):
+        self.running = False
+
+    def archive(self):
+        cutoff = int((time.time() - self.retention * 86400) * 1000000)
+        with self.dbmanager.connection() as db:
+            for name in db.expired(cutoff):
+                if not self.running:
+                    break
+
+                # Never overwrite an earlier archive of the same partition
+                path = os.path.join(self.directory, "{0}.csv.gz".format(name))
+                n = 1
+                while os.path.exists(path):
+                    path = os.path.join(self.directory, "{0}.{1}.csv.gz".format(name, n))
+                    n += 1
+
+                count = db.archive(name, path)
+                self.mcclog.info("Archived {0} packets from partition {1} to {2}".format(count, name, path))
+
+    def run(self):
+        next = 0
+        while self.running:
+            if time.time() >= next:
+                try:
+                    self.archive()
+                except Exception as e:
+                    self.mcclog.warning("Failed to archive partitions ({0})".format(e))
+                next = time.time() + ARCHIVE_INTERVAL
+            time.sleep(1)
+
 # Database manager base class
+# Subclasses provide get_connection(), which opens a new connection. Short
+# lived users check connections out of a bounded pool instead:
+#
+#   with dbmanager.connection() as db:
+#       db.validate_user(user, password)
 class dbmanager():
 
     def __init__(self, mcclog, conf):
         self.mcclog = mcclog
         self.conf = conf
-    
+        if not conf.db_partition in PARTITIONING:
+            raise Exception("Invalid partitioning {0}. Use either {1}".format(conf.db_partition, ", ".join(PARTITIONING)))
+
+        # Connection pool. Idle connections are kept as (connection, last use)
+        # with the most recently used last. open counts idle connections and
+        # connections in use
+        self.poolsize = conf.db_poolsize
+        self.poolidle = conf.db_poolidle
+        self.idle = []
+        self.open = 0
+        self.cond = threading.Condition()
+
+        # Pool statistics
+        self.opened = 0
+        self.evicted = 0
+        self.broken = 0
+        self.waits = 0
+
+        metrics.REGISTRY.gauge("mcc_db_pool_in_use", "Pooled database connections in use", lambda: self.stats()["in_use"])
+        metrics.REGISTRY.gauge("mcc_db_pool_waits_total", "Waits for a free pooled database connection", lambda: self.stats()["waits"], kind="counter")
+
+        # Credential cache, reloaded from the users table after authttl seconds
+        self.authttl = conf.db_authttl
+        self.credentials = None
+        self.loaded = 0
+        self.authlock = threading.Lock()
+
+    # Check a connection out of the pool. Waits at most timeout seconds for
+    # a connection when all poolsize connections are in use
+    def checkout(self, timeout=POOL_TIMEOUT):
+        deadline = time.time() + timeout
+        with self.cond:
+            self.evict()
+            while not self.idle and self.open >= self.poolsize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception("Timed out waiting for a database connection ({0} in use)".format(self.open))
+                self.waits += 1
+                self.cond.wait(remaining)
+                self.evict()
+
+            if self.idle:
+                (db, used) = self.idle.pop()
+            else:
+                # Reserve a slot for a new connection
+                (db, used) = (None, None)
+                self.open += 1
+
+        # Test connections that have been idle for a while
+        if not db == None and time.time() - used > POOL_CHECK and not db.ping():
+            self.mcclog.debug("Discarding broken database connection")
+            db.close()
+            with self.cond:
+                self.broken += 1
+            db = None
+
+        if db == None:
+            try:
+                db = self.get_connection()
+            except:
+                with self.cond:
+                    self.open -= 1
+                    self.cond.notify()
+                raise
+            with self.cond:
+                self.opened += 1
+        return db
+
+    # Return a connection to the pool. Connections that failed are closed
+    def checkin(self, db, failed=False):
+        if failed:
+            db.close()
+        with self.cond:
+            if failed:
+                self.open -= 1
+                self.broken += 1
+            else:
+                self.idle.append((db, time.time()))
+            self.cond.notify()
+
+    # Close connections idle for more than poolidle seconds
+    def evict(self):
+        cutoff = time.time() - self.poolidle
+        while self.idle and self.idle[0][1] < cutoff:
+            (db, used) = self.idle.pop(0)
+            db.close()
+            self.open -= 1
+            self.evicted += 1
+
+    @contextlib.contextmanager
+    def connection(self, timeout=POOL_TIMEOUT):
+        db = self.checkout(timeout)
+        try:
+            yield db
+        except db.error:
+            self.checkin(db, True)
+            raise
+        except:
+            # Other errors leave the connection usable
+            self.checkin(db, not db.rollback())
+            raise
+        else:
+            self.checkin(db)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "size": self.poolsize,
+                "in_use": self.open - len(self.idle),
+                "idle": len(self.idle),
+                "opened": self.opened,
+                "evicted": self.evicted,
+                "broken": self.broken,
+                "waits": self.waits,
+            }
+
+    def close(self):
+        with self.cond:
+            for (db, used) in self.idle:
+                db.close()
+            self.open -= len(self.idle)
+            self.idle = []
+
+    # Reload the credential cache. Returns the number of users
+    def reload_users(self, timeout=POOL_TIMEOUT):
+        with self.connection(timeout) as db:
+            credentials = db.users()
+        with self.authlock:
+            self.credentials = credentials
+            self.loaded = time.time()
+        return len(credentials)
+
+    # Validate a username and password hash against the credential cache
+    def validate_user(self, user, password, timeout=POOL_TIMEOUT):
+        with self.authlock:
+            if self.credentials == None or time.time() - self.loaded > self.authttl:
+                try:
+                    with self.connection(timeout) as db:
+                        self.credentials = db.users()
+                except Exception as e:
+                    if self.credentials == None:
+                        raise
+                    self.mcclog.warning("Failed to reload users - using cached credentials ({0})".format(e))
+                self.loaded = time.time()
+            credentials = self.credentials
+        return credentials.get(user) == password
+
+    def migrate(self):
+        with self.connection() as c:
+            c.migrate()
+
     def test(self):
         # Test connection and structure
-        c = self.get_connection()
-        conn = c.conn
-        cur = conn.cursor()
-        try:
-            cur.execute("select uid,username,password from users limit 1;")
-            cur.execute("select pid,time,dir,source,dest,sport,dport,data from data limit 1;")
-            conn.commit()
-        except Exception as e:
-            raise Exception("Incorrect database structure: {0}".format(e))
+        with self.connection() as c:
+            version = c.schema_version()
+            if version < SCHEMA_VERSION:
+                raise Exception("Database schema version {0} is outdated. Run with --migrate to upgrade to version {1}".format(version, SCHEMA_VERSION))
+            conn = c.conn
+            cur = conn.cursor()
+            try:
+                cur.execute("select uid,username,password from users limit 1;")
+                cur.execute("select pid,time,dir,source,dest,sport,dport,data from data limit 1;")
+                cur.execute("select name,start,stop from partitions limit 1;")
+                conn.commit()
+            except Exception as e:
+                raise Exception("Incorrect database structure: {0}".format(e))
 
 # SQLite database manager
 class sqlitemanager(dbmanager):
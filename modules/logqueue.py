@@ -0,0 +1,113 @@
+# Copyright (c) 2011 Jeppe Ledet-Pedersen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Asynchronous logging
+# Log records are queued by the logging threads and written to the real
+# handlers by a dedicated thread, so slow terminals and log files do not
+# block the packet paths. Messages are only formatted by the writer thread,
+# so per packet messages should pass their arguments to the logger instead
+# of formatting them:
+#
+#   mcclog.debug("Received CSP packet: %s", packet, extra=logqueue.PACKET)
+#
+# Messages marked with PACKET are sampled to a maximum rate per second.
+
+# Python imports
+import threading
+import logging
+import Queue
+
+# Maximum number of records waiting to be written. Records are dropped when full
+QUEUE_SIZE = 10000
+
+# Marks per packet messages subject to sampling
+PACKET = {"packet": True}
+
+# Passes at most rate per packet messages each second. The number of
+# suppressed messages is added to the next message passed
+class sampler(logging.Filter):
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.second = 0
+        self.passed = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate <= 0 or not getattr(record, "packet", False):
+            return True
+
+        with self.lock:
+            second = int(record.created)
+            if not second == self.second:
+                self.second = second
+                self.passed = 0
+            if self.passed >= self.rate:
+                self.suppressed += 1
+                return False
+            self.passed += 1
+            if self.suppressed:
+                record.msg = "{0} ({1} packet messages suppressed)".format(record.msg, self.suppressed)
+                self.suppressed = 0
+        return True
+
+class queuehandler(logging.Handler):
+    def __init__(self, size=QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.queue = Queue.Queue(size)
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+# Writes queued records to the handlers. Remaining records are written
+# before the thread exits
+class logwriter(threading.Thread):
+    def __init__(self, queuehandler, handlers):
+        threading.Thread.__init__(self, None)
+        self.queuehandler = queuehandler
+        self.handlers = handlers
+
+        # Set thread state - self.daemon is important!
+        self.daemon = True
+        self.running = True
+
+        # Start thread
+        self.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while True:
+            try:
+                record = self.queuehandler.queue.get(True, 0.1)
+            except Queue.Empty:
+                if not self.running:
+                    break
+                continue
+
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
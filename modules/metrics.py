@@ -0,0 +1,205 @@
+# Copyright (c) 2011 Jeppe Ledet-Pedersen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Metrics registry
+# Counters and gauges are registered by name in REGISTRY. They are exported
+# in the Prometheus text format by the web interface and listed by the STATS
+# command. Gauges are read from a function when exported, so components only
+# pay for counting.
+
+# Python imports
+import threading
+import time
+import bisect
+
+# Length in seconds of the window used to compute counter rates
+RATE_WINDOW = 10
+
+# Monotonically increasing count. The rate is computed over the last
+# complete window of RATE_WINDOW seconds
+class counter():
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+        # Counts in the current and the previous window
+        self.window = int(time.time() / RATE_WINDOW)
+        self.current = 0
+        self.previous = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.roll()
+            self.value += n
+            self.current += n
+
+    def roll(self):
+        window = int(time.time() / RATE_WINDOW)
+        if not window == self.window:
+            self.previous = self.current if window == self.window + 1 else 0
+            self.current = 0
+            self.window = window
+
+    def rate(self):
+        with self.lock:
+            self.roll()
+            return float(self.previous) / RATE_WINDOW
+
+    def samples(self):
+        return [("", self.value)]
+
+# Value read from func when exported. If labels is given, func returns a
+# dict mapping tuples of label values to values. Counters maintained
+# elsewhere are exported by setting kind to "counter"
+class gauge():
+    def __init__(self, name, help, func, labels=None, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labels = labels
+        self.kind = kind
+
+    def samples(self):
+        value = self.func()
+        if self.labels == None:
+            return [("", value)]
+        samples = []
+        for (key, value) in sorted(value.items()):
+            pairs = ["{0}=\"{1}\"".format(label, str(v).replace("\\", "\\\\").replace("\"", "\\\"")) for (label, v) in zip(self.labels, key)]
+            samples.append(("{{{0}}}".format(",".join(pairs)), value))
+        return samples
+
+# Distribution of observed values in exponentially growing buckets. Quantiles
+# are estimated as the upper bound of the bucket holding them
+class histogram():
+    kind = "histogram"
+
+    # Upper bounds from 10 us to about 10 s
+    BUCKETS = [0.00001 * 2 ** i for i in range(21)]
+
+    def __init__(self, name, help, buckets=None):
+        self.name = name
+        self.help = help
+        if not buckets == None:
+            self.BUCKETS = buckets
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.BUCKETS, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        with self.lock:
+            rank = q * self.count
+            seen = 0
+            for (i, n) in enumerate(self.counts):
+                seen += n
+                if n and seen >= rank:
+                    return min(self.BUCKETS[i], self.max) if i < len(self.BUCKETS) else self.max
+            return 0.0
+
+    def samples(self):
+        with self.lock:
+            samples = []
+            seen = 0
+            for (bound, n) in zip(self.BUCKETS + ["+Inf"], self.counts):
+                seen += n
+                samples.append(("_bucket{{le=\"{0}\"}}".format(bound), seen))
+            samples.append(("_sum", self.sum))
+            samples.append(("_count", self.count))
+        return samples
+
+class registry():
+    def __init__(self):
+        self.metrics = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    # Register a metric. A metric registered again under the same name
+    # replaces the old one
+    def add(self, metric):
+        with self.lock:
+            if not metric.name in self.metrics:
+                self.order.append(metric.name)
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.add(counter(name, help))
+
+    def gauge(self, name, help, func, labels=None, kind="gauge"):
+        return self.add(gauge(name, help, func, labels, kind))
+
+    def histogram(self, name, help, buckets=None):
+        return self.add(histogram(name, help, buckets))
+
+    def collect(self):
+        with self.lock:
+            return [self.metrics[name] for name in self.order]
+
+    # Prometheus text exposition format
+    def export(self):
+        lines = []
+        for metric in self.collect():
+            try:
+                samples = metric.samples()
+            except Exception:
+                continue
+            lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.kind))
+            for (labels, value) in samples:
+                lines.append("{0}{1} {2}".format(metric.name, labels, value))
+        return "\n".join(lines) + "\n"
+
+    # List of (name, value) including the rate of counters
+    def summary(self):
+        values = []
+        for metric in self.collect():
+            try:
+                samples = metric.samples()
+            except Exception:
+                continue
+            if isinstance(metric, histogram):
+                # Quantiles instead of buckets, in the unit ending the name
+                (name, unit) = metric.name.rsplit("_", 1)
+                values.append((name + "_count", metric.count))
+                for (q, suffix) in ((0.5, "p50"), (0.99, "p99")):
+                    values.append(("{0}_{1}_{2}".format(name, suffix, unit), "{0:.6f}".format(metric.quantile(q))))
+                values.append(("{0}_max_{1}".format(name, unit), "{0:.6f}".format(metric.max)))
+                continue
+            for (labels, value) in samples:
+                values.append((metric.name + labels, value))
+            if isinstance(metric, counter):
+                values.append((metric.name.replace("_total", "") + "_per_second", "{0:.1f}".format(metric.rate())))
+        return values
+
+REGISTRY = registry()
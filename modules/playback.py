@@ -0,0 +1,105 @@
+# Copyright (c) 2011 Jeppe Ledet-Pedersen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Playback of recorded traffic
+# Received packets logged between start and stop are read from the database
+# and added to the incoming queue, as if they had just been received. The
+# original spacing of the packets is kept, divided by speed. A speed of 0
+# plays the packets back as fast as possible.
+
+# Python imports
+import threading
+import time
+
+# AAUSAT3 imports
+import connection
+import tracing
+
+class playback(threading.Thread):
+    def __init__(self, mcclog, dbmanager, inq, conf):
+        threading.Thread.__init__(self, None)
+        self.mcclog = mcclog
+        self.dbmanager = dbmanager
+        self.inq = inq
+        self.start_time = connection.parse_time(conf.playback_start)
+        self.stop_time = connection.parse_time(conf.playback_stop)
+        self.speed = conf.playback_speed
+        self.loop = conf.playback_loop
+        if self.speed < 0:
+            raise Exception("Invalid playback speed {0}".format(self.speed))
+
+        # Statistics
+        self.played = 0
+
+        # Set thread state - self.daemon is important!
+        self.daemon = True
+        self.running = True
+
+        # Start thread
+        self.start()
+
+    def stop(self):
+        self.running = False
+
+    # Play the recording once. Returns the number of packets played
+    def play(self):
+        played = 0
+        with self.dbmanager.connection() as db:
+            replay = db.replay_range(self.start_time, self.stop_time)
+        self.mcclog.info("Playing back {0} packets at {1}".format(replay.count, "{0}x speed".format(self.speed) if self.speed > 0 else "full speed"))
+        first = None
+        while True:
+            # Check a connection out per chunk so none is held while pacing
+            with self.dbmanager.connection() as db:
+                packets = replay.fetch(db)
+            if packets == None:
+                break
+            for p in packets:
+                if not self.running:
+                    return played
+
+                # Wait until the packet is due
+                if self.speed > 0:
+                    if first == None:
+                        first = (p.time, time.time())
+                    due = first[1] + (p.time - first[0]) / 1000000.0 / self.speed
+                    while self.running and due - time.time() > 0:
+                        time.sleep(min(0.5, due - time.time()))
+
+                # Replayed packets appear as just received
+                now = time.time()
+                p.update_time(int(round(now * 1000000)))
+                tracing.start(p, now)
+                tracing.stamp(p)
+                self.inq.put(p)
+                played += 1
+        return played
+
+    def run(self):
+        while self.running:
+            try:
+                played = self.play()
+            except Exception as e:
+                self.mcclog.error("Playback failed ({0})".format(e))
+                break
+            self.played += played
+            self.mcclog.info("Played back {0} packets".format(played))
+            if not self.loop or played == 0:
+                break
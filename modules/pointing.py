@@ -0,0 +1,65 @@
+# Copyright (c) 2011 Jeppe Ledet-Pedersen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Pointing table
+# The position of a spacecraft is sampled over a whole pass before AOS, so
+# the tracking loop only interpolates between samples
+
+# Python imports
+import math
+import numpy
+
+# AAUSAT3 imports
+import tracker
+
+class pointing():
+    def __init__(self, obs, sc, start, stop, frequency, step):
+        # Sample times in seconds after the epoch, including LOS
+        self.times = numpy.append(numpy.arange(start, stop, step), stop)
+        
+        az = numpy.empty(len(self.times))
+        self.elv = numpy.empty(len(self.times))
+        self.alt = numpy.empty(len(self.times))
+        self.range = numpy.empty(len(self.times))
+        self.range_velocity = numpy.empty(len(self.times))
+        for (i, t) in enumerate(self.times):
+            obs.date = tracker.ephemdate(t)
+            sc.compute(obs)
+            az[i] = sc.az
+            self.elv[i] = sc.alt
+            self.alt[i] = sc.elevation
+            self.range[i] = sc.range
+            self.range_velocity[i] = sc.range_velocity
+
+        # Azimuth is unwrapped so it can be interpolated across north
+        self.az = numpy.degrees(numpy.unwrap(az))
+        self.elv = numpy.degrees(self.elv)
+        self.doppler = tracker.doppler_shift(frequency, self.range_velocity)
+
+    def interpolate(self, column, t):
+        return numpy.interp(t, self.times, column)
+
+    def position(self, t):
+        # Azimuth and elevation in degrees at time t
+        return (self.interpolate(self.az, t) % 360, self.interpolate(self.elv, t))
+
+    def shift(self, t):
+        # Doppler shift in Hz at time t
+        return self.interpolate(self.doppler, t)
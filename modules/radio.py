@@ -23,11 +23,27 @@
 # This library still lacks implementation
 # Requires well defined interface to COM config over CSP 
 
+# Frequency corrections are sent through the control slot of the uplink
+# scheduler, so they do not wait behind user packets and a correction not
+# yet sent is replaced by the next
+
 # Python imports
 import struct
 
 # AAUSAT3 imports
 import csp
+import pycsp
+import metrics
+
+UPDATES = metrics.REGISTRY.counter("mcc_radio_updates_total", "Frequency corrections queued for the radio")
+SUPERSEDED = metrics.REGISTRY.counter("mcc_radio_superseded_total", "Frequency corrections replaced before being sent")
+SKIPPED = metrics.REGISTRY.counter("mcc_radio_skipped_total", "Frequency corrections smaller than the step size")
+
+# Frequencies the radio can be tuned to around its configured frequency
+RANGE = 1000000
+
+def valid(center, frequency):
+    return center - RANGE <= frequency <= center + RANGE
 
 class radio():
     def __init__(self, mcclog, outqueue, conf):
@@ -36,20 +52,25 @@ class radio():
         self.frequency = conf.frequency
         self.radioaddress = conf.radioaddress
         self.radioport = conf.radioport
+        self.step = conf.radiostep
+
+        # Last frequency queued
+        self.current = None
         self.set_frequency(437475000)
         
     def set_frequency(self, frequency):
-        if (frequency < self.frequency - 1000000 or frequency > self.frequency + 1000000):
+        if not valid(self.frequency, frequency):
             raise Exception("Invalid frequency {0}".format(frequency))
+        elif not self.current == None and abs(frequency - self.current) < self.step:
+            SKIPPED.inc()
         else:
             # Create CSP packet
             magic_word = 0x12345678
-            packet = csp.packet(-1, -1, self.radioaddress, self.radioport, [struct.unpack("<B", i)[0] for i in tuple(struct.pack("<II", frequency, magic_word))])
-            try:
-                self.outqueue.put(packet, True, 1)
-            except Queue.Full:
-                self.mcclog.warning("Failed to set radio frequency to {0} Hz".format(frequency))
-            else:
-                self.mcclog.info("Setting radio frequency to {0} Hz".format(frequency))
+            packet = csp.packet(-1, -1, self.radioaddress, self.radioport, struct.pack("<II", int(frequency), magic_word), pycsp.CSP_PRIO_HIGH)
+            if self.outqueue.put_control("radio", packet):
+                SUPERSEDED.inc()
+            UPDATES.inc()
+            self.current = frequency
+            self.mcclog.debug("Setting radio frequency to {0:.0f} Hz".format(frequency))
             
             
@@ -0,0 +1,448 @@
+# Copyright (c) 2011 Jeppe Ledet-Pedersen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Event driven client engine
+# All client sockets are multiplexed by a single thread using epoll (or poll
+# where epoll is not available) with non-blocking reads and writes
+
+# Python imports
+import threading
+import socket
+import select
+import errno
+import os
+import ssl
+import time
+import heapq
+import collections
+import Queue
+
+# AAUSAT3 imports
+import connection
+import connmanager
+import tracing
+
+# Poll event masks
+if hasattr(select, "epoll"):
+    EV_READ = select.EPOLLIN
+    EV_WRITE = select.EPOLLOUT
+    EV_ERROR = select.EPOLLERR | select.EPOLLHUP
+else:
+    EV_READ = select.POLLIN
+    EV_WRITE = select.POLLOUT
+    EV_ERROR = select.POLLERR | select.POLLHUP
+
+# Largest chunk passed to a single socket write
+WRITE_CHUNK = 16384
+
+# Packets are only read from the ring while less than this is buffered
+HIGH_WATER = 65536
+
+# Maximum number of packets read from the ring in one go
+READ_CHUNK = 256
+
+# Errors meaning a non-blocking operation should be retried later
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Threads running database work for clients
+WORKERS = 4
+
+class poller():
+    def __init__(self):
+        self.epoll = hasattr(select, "epoll")
+        if self.epoll:
+            self.poll = select.epoll()
+        else:
+            self.poll = select.poll()
+
+    def register(self, fd, events):
+        self.poll.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poll.modify(fd, events)
+
+    def unregister(self, fd):
+        self.poll.unregister(fd)
+
+    def wait(self, timeout):
+        try:
+            if self.epoll:
+                return self.poll.poll(timeout)
+            else:
+                return self.poll.poll(timeout * 1000)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+class client(connection.handler):
+    def __init__(self, mcclog, reactor, socket, address, dbmanager, connlist, ring, outqueue, conf):
+        connection.handler.__init__(self, mcclog, address, dbmanager, connlist, ring, outqueue, conf)
+        self.reactor = reactor
+        self.socket = socket
+        self.sock = socket.get_socket()
+        self.fd = self.sock.fileno()
+        self.secure = socket.type == connmanager.TYPE_SECURE
+        self.sock.setblocking(False)
+
+        # Input and output buffers
+        self.inbuf = ""
+        self.outbuf = collections.deque()
+        self.outlen = 0
+        self.chunk = None
+
+        # Total bytes queued and sent, and traces waiting for their packets
+        # to be sent as (queued bytes, token)
+        self.queued = 0
+        self.sent = 0
+        self.traces = collections.deque()
+
+        # Connection state
+        self.events = 0
+        self.hold = 0
+        self.closing = False
+
+        # Set while work deferred to a worker thread is running
+        self.busy = False
+        self.done = threading.Event()
+
+    # Called by other threads
+    def notify(self):
+        self.reactor.notify(self)
+
+    def stop(self):
+        self.reactor.call(self.close)
+
+    def join(self, timeout=None):
+        self.done.wait(timeout)
+
+    # Called by the reactor thread
+    def write(self, data):
+        self.outbuf.append(data)
+        self.outlen += len(data)
+        self.queued += len(data)
+
+    def delay(self, seconds):
+        # Hold input processing and output until the delay has passed
+        self.hold = time.time() + seconds
+        self.reactor.schedule(self.hold, self)
+
+    def held(self):
+        return self.hold > time.time()
+
+    def defer(self, work, done):
+        # Commands are not handled until done has run
+        self.busy = True
+        self.reactor.submit(self, work, done)
+        return True
+
+    def interest(self):
+        if self.held():
+            return 0
+        events = EV_READ if not self.closing and not self.busy else 0
+        if self.outlen or self.chunk:
+            events |= EV_WRITE
+        return events
+
+    def fill(self):
+        # Read the next chunk of replayed packets when the buffer runs low
+        if not self.replaying == None and not self.busy and not self.closing and self.outlen < HIGH_WATER:
+            replay = self.replaying
+            self.defer(lambda: self.fetch_replay(replay), self.on_replay)
+
+        # Copy packets from the ring until enough data is buffered
+        while self.enabled and not self.closing and self.outlen < HIGH_WATER and self.ring.skip(self, self.cursor) < self.ring.head:
+            lines = self.forward(READ_CHUNK)
+            if lines == None:
+                self.write(self.slow())
+                self.closing = True
+            else:
+                self.write("".join(lines))
+                if not self.traced == None:
+                    self.traces.append((self.queued, self.traced))
+                    self.traced = None
+
+    def on_replay(self, packets, error):
+        data = self.replayed(packets, error)
+        if not data == None:
+            self.write(data)
+        return True
+
+    def on_read(self):
+        while True:
+            try:
+                data = self.socket.read(2048)
+            except ssl.SSLError as e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                    break
+                self.mcclog.debug("Socket error on connection with {0} ({1})".format(self.address, str(e)))
+                self.close()
+                return
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    break
+                self.mcclog.debug("Socket error on connection with {0} ({1})".format(self.address, str(e)))
+                self.close()
+                return
+
+            if not data:
+                self.close()
+                return
+
+            self.inbuf += data
+
+            # TLS may hold decrypted data that is not signalled by poll
+            if not self.secure or not self.sock.pending():
+                break
+
+        self.process()
+
+    def process(self):
+        # Commands are not handled while replaying, as with the threaded engine
+        while not self.closing and not self.held() and not self.busy and self.replaying == None and "\n" in self.inbuf:
+            (msg, self.inbuf) = self.inbuf.split("\n", 1)
+
+            # An empty line closes the connection
+            if not msg.strip():
+                self.close()
+                return
+
+            if not self.handle(msg):
+                self.closing = True
+
+    def on_write(self):
+        while self.chunk or self.outbuf:
+            if self.chunk == None:
+                # Coalesce buffered data into one chunk. A TLS write must be
+                # retried with the same chunk, so it is kept until sent
+                parts = []
+                size = 0
+                while self.outbuf and size < WRITE_CHUNK:
+                    parts.append(self.outbuf.popleft())
+                    size += len(parts[-1])
+                self.chunk = "".join(parts)
+                self.outlen -= size
+
+            try:
+                if self.secure:
+                    n = self.sock.write(self.chunk)
+                else:
+                    n = self.sock.send(self.chunk)
+            except ssl.SSLError as e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                    return
+                self.mcclog.error("Failed to send data to {0} ({1})".format(self.address, e))
+                self.close()
+                return
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                self.mcclog.error("Failed to send data to {0} ({1})".format(self.address, e))
+                self.close()
+                return
+
+            self.sent += n
+            while self.traces and self.traces[0][0] <= self.sent:
+                tracing.written(self.traces.popleft()[1])
+
+            if n < len(self.chunk):
+                self.chunk = self.chunk[n:]
+                return
+            self.chunk = None
+
+        if self.closing:
+            self.close()
+
+    def close(self):
+        if self.done.is_set():
+            return
+        self.reactor.remove(self)
+        try:
+            self.sock.close()
+        except:
+            pass
+        self.closed()
+        self.done.set()
+
+class reactor(threading.Thread):
+    def __init__(self, mcclog):
+        threading.Thread.__init__(self, None)
+        self.mcclog = mcclog
+        self.poller = poller()
+        self.clients = {}
+        self.timers = []
+
+        # Wakeup pipe used by other threads
+        (self.wake_r, self.wake_w) = os.pipe()
+        self.poller.register(self.wake_r, EV_READ)
+        self.lock = threading.Lock()
+        self.woken = False
+        self.calls = collections.deque()
+
+        # Clients with new packets in the ring
+        self.notified = set()
+
+        # Database work is run by worker threads
+        self.work = Queue.Queue()
+        self.workers = [threading.Thread(target=self.worker) for i in range(WORKERS)]
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+
+        # Set thread state - self.daemon is important!
+        self.daemon = True
+        self.running = True
+
+        # Start thread
+        self.start()
+
+    def stop(self):
+        self.running = False
+        for w in self.workers:
+            self.work.put(None)
+        self.wakeup()
+
+    def wakeup(self):
+        with self.lock:
+            if self.woken:
+                return
+            self.woken = True
+        os.write(self.wake_w, "x")
+
+    # Thread safe interface
+    def add(self, c):
+        self.call(lambda: self.register(c))
+
+    def call(self, func):
+        self.calls.append(func)
+        self.wakeup()
+
+    def notify(self, c):
+        with self.lock:
+            self.notified.add(c)
+        self.wakeup()
+
+    def submit(self, c, work, done):
+        self.work.put((c, work, done))
+
+    # Worker thread interface
+    def worker(self):
+        while True:
+            item = self.work.get()
+            if item == None:
+                break
+            (c, work, done) = item
+            try:
+                (result, error) = (work(), None)
+            except Exception as e:
+                (result, error) = (None, e)
+            self.call(lambda c=c, done=done, result=result, error=error: self.complete(c, done, result, error))
+
+    # Reactor thread interface
+    def register(self, c):
+        self.clients[c.fd] = c
+        c.greeting()
+        c.events = c.interest()
+        self.poller.register(c.fd, c.events)
+
+    def remove(self, c):
+        if self.active(c):
+            del self.clients[c.fd]
+            try:
+                self.poller.unregister(c.fd)
+            except:
+                pass
+
+    def complete(self, c, done, result, error):
+        c.busy = False
+        if not self.active(c):
+            return
+        if not done(result, error):
+            c.closing = True
+        # Handle commands received meanwhile
+        c.process()
+        self.update(c)
+
+    def schedule(self, deadline, c):
+        heapq.heappush(self.timers, (deadline, c))
+
+    def active(self, c):
+        return self.clients.get(c.fd) is c
+
+    def update(self, c):
+        if not self.active(c):
+            return
+        if c.closing and not c.outlen and not c.chunk:
+            c.close()
+            return
+        c.fill()
+        events = c.interest()
+        if events != c.events:
+            self.poller.modify(c.fd, events)
+            c.events = events
+
+    def run(self):
+        while self.running:
+            # Sleep until the next timer expires
+            if self.timers:
+                timeout = max(0.0, min(1.0, self.timers[0][0] - time.time()))
+            else:
+                timeout = 1.0
+
+            for (fd, events) in self.poller.wait(timeout):
+                if fd == self.wake_r:
+                    os.read(self.wake_r, 4096)
+                    with self.lock:
+                        self.woken = False
+                    continue
+
+                c = self.clients.get(fd)
+                if c == None:
+                    continue
+                if events & (EV_READ | EV_ERROR):
+                    c.on_read()
+                if events & EV_WRITE and self.active(c):
+                    c.on_write()
+                self.update(c)
+
+            # Run calls from other threads
+            while self.calls:
+                self.calls.popleft()()
+
+            # Forward new packets from the ring to notified clients
+            with self.lock:
+                notified = self.notified
+                self.notified = set()
+            for c in notified:
+                self.update(c)
+
+            # Release clients whose delay has expired
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                (deadline, c) = heapq.heappop(self.timers)
+                if self.active(c) and not c.held():
+                    c.process()
+                    self.update(c)
+
+        # Close remaining clients
+        for c in self.clients.values():
+            c.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
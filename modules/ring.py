@@ -0,0 +1,196 @@
+# Copyright (c) 2011 Jeppe Ledet-Pedersen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Broadcast ring buffer
+# Every packet is encoded once and stored in a fixed size ring. Clients keep
+# a cursor (the sequence number of the next packet to send) and read from the
+# ring at their own pace. A client that falls more than size packets behind
+# loses the oldest packets and is told how many were lost.
+#
+# Clients subscribe to (source, dport) keys, where None matches any source or
+# port. The ring keeps an index from keys to subscribed clients, so only
+# clients interested in a packet are woken up when it is added. For each
+# subscribed client it also counts the matching packets not yet read and
+# marks the first of them, so backlog and losses are counted in subscribed
+# packets and clients skip other packets without reading them. A new
+# subscription starts at the head of the ring.
+
+# Python imports
+import threading
+
+# Key matching every packet
+ALL = (None, None)
+
+# Test if a packet key matches a set of subscribed keys
+def matches(keys, key):
+    return key in keys or (key[0], None) in keys or (None, key[1]) in keys or ALL in keys
+
+class ring():
+    def __init__(self, size):
+        self.size = size
+        self.lines = [None] * size
+        self.keys = [None] * size
+        self.traces = [None] * size
+
+        # Sequence number of the next packet
+        self.head = 0
+
+        # Subscribed clients by key
+        self.index = {}
+
+        # Unread matching packets of each subscribed client, and the first
+        # of them (None if there are none)
+        self.pending = {}
+        self.marks = {}
+
+        self.lock = threading.Lock()
+
+    # Subscribe client to a list of keys. Clients must provide notify()
+    def subscribe(self, client, keys):
+        with self.lock:
+            self.remove(client)
+            for key in keys:
+                self.index.setdefault(key, set()).add(client)
+            self.pending[client] = 0
+            self.marks[client] = None
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.remove(client)
+
+    def remove(self, client):
+        for key in self.index.keys():
+            self.index[key].discard(client)
+            if not self.index[key]:
+                del self.index[key]
+        self.pending.pop(client, None)
+        self.marks.pop(client, None)
+
+    def append(self, packet):
+        key = (packet.source, packet.dport)
+        line = "PACKET {0}\n".format(packet.tostring())
+        with self.lock:
+            self.lines[self.head % self.size] = line
+            self.keys[self.head % self.size] = key
+            self.traces[self.head % self.size] = packet.trace
+            self.head += 1
+
+            # Look up interested clients
+            clients = set()
+            for k in (key, (key[0], None), (None, key[1]), ALL):
+                if k in self.index:
+                    clients.update(self.index[k])
+            for client in clients:
+                self.pending[client] += 1
+                if self.marks[client] == None:
+                    self.marks[client] = self.head - 1
+
+        for client in clients:
+            client.notify()
+
+    # Number of unread packets matching a subscribed client
+    def backlog(self, client):
+        with self.lock:
+            return self.pending.get(client, 0)
+
+    # Move the cursor of a subscribed client past the packets before its
+    # first unread match. Returns the new cursor
+    def skip(self, client, cursor):
+        with self.lock:
+            return self.start(client, cursor)
+
+    def start(self, client, cursor):
+        if not client in self.marks:
+            return cursor
+        mark = self.marks[client]
+        return max(cursor, self.head if mark == None else mark)
+
+    # Number of packets matching keys from cursor to end
+    def count(self, cursor, end, keys):
+        if keys == None:
+            return end - cursor
+        return len([seq for seq in xrange(cursor, end) if matches(keys, self.keys[seq % self.size])])
+
+    # Number of unread packets of a subscribed client overwritten before
+    # cursor was read
+    def overwritten(self, client, cursor, keys):
+        oldest = self.head - self.size
+        if cursor >= oldest:
+            return 0
+        if not client in self.pending:
+            return oldest - cursor
+        return self.pending[client] - self.count(oldest, self.head, keys)
+
+    # Account packets read or lost by a subscribed client up to end
+    def consumed(self, client, num, end):
+        if client in self.pending:
+            self.pending[client] -= num
+            if self.pending[client] <= 0:
+                self.pending[client] = 0
+                self.marks[client] = None
+            else:
+                self.marks[client] = max(self.marks[client], end)
+
+    # Discard the oldest num unread packets matching keys from cursor.
+    # Returns (new cursor, number of packets discarded)
+    def drop(self, cursor, num, keys=None, client=None):
+        with self.lock:
+            cursor = self.start(client, cursor)
+            dropped = self.overwritten(client, cursor, keys)
+            cursor = max(cursor, self.head - self.size)
+            while dropped < num and cursor < self.head:
+                if keys == None or matches(keys, self.keys[cursor % self.size]):
+                    dropped += 1
+                cursor += 1
+            self.consumed(client, dropped, cursor)
+        return (cursor, dropped)
+
+    # Read at most num packets from cursor. Only packets matching the keys
+    # are returned, unless keys is None. If traces is a list, the latency
+    # traces of the returned packets are added to it. Reads of a subscribed
+    # client are accounted in its backlog.
+    # Returns (lines, new cursor, number of packets lost)
+    def read(self, cursor, num, keys=None, traces=None, client=None):
+        with self.lock:
+            cursor = self.start(client, cursor)
+            lost = self.overwritten(client, cursor, keys)
+            cursor = max(cursor, self.head - self.size)
+            end = min(self.head, cursor + num)
+
+            # Copy at most two slices of the ring
+            first = cursor % self.size
+            last = first + (end - cursor)
+            if last <= self.size:
+                slots = slice(first, last)
+                lines = self.lines[slots]
+                if not keys == None:
+                    lines = [line for (line, key) in zip(lines, self.keys[slots]) if matches(keys, key)]
+                if not traces == None:
+                    traces.extend([t for (t, key) in zip(self.traces[slots], self.keys[slots]) if keys == None or matches(keys, key)])
+            else:
+                lines = self.lines[first:] + self.lines[:last - self.size]
+                if not keys == None:
+                    lines = [line for (line, key) in zip(lines, self.keys[first:] + self.keys[:last - self.size]) if matches(keys, key)]
+                if not traces == None:
+                    traces.extend([t for (t, key) in zip(self.traces[first:] + self.traces[:last - self.size], self.keys[first:] + self.keys[:last - self.size]) if keys == None or matches(keys, key)])
+
+            self.consumed(client, lost + len(lines), end)
+        return (lines, end, lost)
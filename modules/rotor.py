@@ -19,17 +19,37 @@
 # THE SOFTWARE.
 
 # Rotor control using Hamlib (hamlib.org)
+# Positions are sent by a driver thread, so a slow serial link does not
+# delay the tracker. Only the latest position requested is sent
 
 # Python imports
 import Hamlib
 import os.path
+import threading
+import time
 
-class rotor():
+# AAUSAT3 imports
+import metrics
+
+COMMANDS = metrics.REGISTRY.counter("mcc_rotor_commands_total", "Positions sent to the rotor")
+DEADBAND = metrics.REGISTRY.counter("mcc_rotor_deadband_total", "Positions not sent as they were within the deadband")
+LATENCY = metrics.REGISTRY.histogram("mcc_rotor_command_seconds", "Time from a position being requested until sent to the rotor")
+ERROR = metrics.REGISTRY.histogram("mcc_rotor_error_degrees", "Difference between the requested and read back rotor position",
+    [0.1 * 2 ** i for i in range(12)])
+
+def distance(a, b):
+    # Largest azimuth or elevation difference in degrees
+    return max(abs((a[0] - b[0] + 180) % 360 - 180), abs(a[1] - b[1]))
+
+class rotor(threading.Thread):
     def __init__(self, mcclog, conf):
+        threading.Thread.__init__(self, None)
         self.mcclog = mcclog
         self.rotortype = conf.rotortype
         self.rotorport = conf.rotorport
         self.rotorspeed = conf.rotorspeed
+        self.deadband = conf.rotordeadband
+        self.readback = conf.rotorreadback
         
         # Disable all debug output from Hamlib
         Hamlib.rig_set_debug (Hamlib.RIG_DEBUG_NONE)
@@ -69,10 +89,91 @@ class rotor():
         self.rot.open()
 
         self.mcclog.info("Rotor initiated to {0} on port {1}, speed={2}".format(self.rotortype, self.rotorport, self.rotorspeed))
+
+        # Position waiting to be sent as (az, elv, time requested), the latest
+        # position requested and the last position sent
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.pending = None
+        self.target = None
+        self.commanded = None
+
+        # Tracking error measured by the last readback
+        self.error = 0.0
+        metrics.REGISTRY.gauge("mcc_rotor_tracking_error_degrees", "Tracking error at the last rotor readback", lambda: self.error)
+
+        # Set thread state - self.daemon is important!
+        self.daemon = True
+        self.running = True
+
+        # Start thread
+        self.start()
+
+    def stop(self):
+        self.running = False
+        self.event.set()
         
     def set_position(self, az, elv):
         if (az < 0 or az > 360):
             raise Exception("Invalid azimuth or elevation")
         else:
-            self.mcclog.info("Setting rotor to AZ={0:.1f} EL={1:.1f}".format(az, elv))
+            # The rotor does not point below the horizon
+            elv = max(elv, 0.0)
+
+            # Replace any position not yet sent
+            with self.lock:
+                self.pending = (az, elv, time.time())
+                self.target = (az, elv)
+            self.event.set()
+
+    def command(self, az, elv, requested):
+        if not self.commanded == None and distance(self.commanded, (az, elv)) < self.deadband:
+            DEADBAND.inc()
+            return
+
+        try:
             self.rot.set_position(az, elv)
+        except Exception as e:
+            self.mcclog.warning("Failed to set rotor position ({0})".format(e))
+            return
+
+        self.commanded = (az, elv)
+        COMMANDS.inc()
+        LATENCY.observe(time.time() - requested)
+        self.mcclog.debug("Setting rotor to AZ={0:.1f} EL={1:.1f} ({2:.0f} ms)".format(az, elv, (time.time() - requested) * 1000))
+
+    def read(self):
+        try:
+            (az, elv) = self.rot.get_position()[:2]
+        except Exception as e:
+            self.mcclog.warning("Failed to read rotor position ({0})".format(e))
+            return
+
+        with self.lock:
+            target = self.target
+        if not target == None:
+            self.error = distance(target, (az, elv))
+            ERROR.observe(self.error)
+            self.mcclog.debug("Rotor at AZ={0:.1f} EL={1:.1f}, tracking error {2:.1f} degrees".format(az, elv, self.error))
+
+    def run(self):
+        last = 0
+        while self.running:
+            # Wait for a new position or the next readback
+            if self.readback > 0:
+                self.event.wait(max(0, last + self.readback - time.time()))
+            else:
+                self.event.wait()
+            self.event.clear()
+            if not self.running:
+                break
+
+            with self.lock:
+                pending = self.pending
+                self.pending = None
+            if not pending == None:
+                self.command(*pending)
+
+            if self.readback > 0 and time.time() >= last + self.readback:
+                self.read()
+                last = time.time()
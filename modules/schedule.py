@@ -0,0 +1,109 @@
+# Copyright (c) 2011 Jeppe Ledet-Pedersen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Pass schedule
+# Passes are computed ahead by the tracker and kept here, so the web
+# interface and clients can look them up without ephemeris computations.
+# Overlapping passes are resolved by a policy, and only the passes that
+# won are tracked
+
+# Python imports
+import threading
+import time
+
+# Order in which passes are considered when resolving conflicts
+POLICIES = {
+    "priority": lambda p, priorities: (-priorities.get(p.spacecraft, 0), p.aos),
+    "first": lambda p, priorities: (p.aos,),
+    "elevation": lambda p, priorities: (-p.maxelv, p.aos),
+}
+
+class satpass():
+    def __init__(self, spacecraft, aos, tca, los, maxelv, aosaz, losaz):
+        # Times are seconds after the epoch, angles are degrees
+        self.spacecraft = spacecraft
+        self.aos = aos
+        self.tca = tca
+        self.los = los
+        self.maxelv = maxelv
+        self.aosaz = aosaz
+        self.losaz = losaz
+        self.tracked = True
+
+    def __str__(self):
+        return "{0} {1} {2} {3} {4:.1f} {5:.1f} {6:.1f} {7}".format(
+            self.spacecraft,
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.aos)),
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.tca)),
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.los)),
+            self.maxelv, self.aosaz, self.losaz, "track" if self.tracked else "skip")
+
+class schedule():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.passes = []
+
+        # Element set the passes of each spacecraft were computed from, and
+        # the end of the period searched for passes
+        self.elements = {}
+        self.horizons = {}
+
+    def replace(self, spacecraft, elements, passes, horizon):
+        with self.lock:
+            self.passes = sorted([p for p in self.passes if not p.spacecraft == spacecraft] + passes, key=lambda p: p.aos)
+            self.elements[spacecraft] = elements
+            self.horizons[spacecraft] = horizon
+
+    def extend(self, spacecraft, passes, horizon):
+        now = time.time()
+        with self.lock:
+            # Drop passes that have ended
+            self.passes = sorted([p for p in self.passes if p.los > now] + passes, key=lambda p: p.aos)
+            self.horizons[spacecraft] = horizon
+
+    def resolve(self, policy, priorities, margin):
+        # Track passes in policy order unless they overlap a pass already
+        # tracked. Passes must be margin seconds apart. Returns the number
+        # of passes skipped
+        with self.lock:
+            tracked = []
+            for p in sorted(self.passes, key=lambda p: POLICIES[policy](p, priorities)):
+                if not [q for q in tracked if p.aos < q.los + margin and q.aos < p.los + margin]:
+                    tracked.append(p)
+            for p in self.passes:
+                p.tracked = p in tracked
+            return len(self.passes) - len(tracked)
+
+    def upcoming(self, num=None, now=None):
+        if now == None:
+            now = time.time()
+        with self.lock:
+            passes = [p for p in self.passes if p.los > now]
+        return passes[:num]
+
+    def next(self, now=None):
+        # Next pass to track
+        for p in self.upcoming(None, now):
+            if p.tracked:
+                return p
+        return None
+
+# Global schedule
+SCHEDULE = schedule()
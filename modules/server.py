@@ -37,6 +37,15 @@ import connmanager
 import csp
 import tracker
 import web
+import ring
+import playback
+import metrics
+import tracing
+import logqueue
+
+# Metrics
+FANOUT_PACKETS = metrics.REGISTRY.counter("mcc_fanout_packets_total", "Packets distributed to clients")
+FANOUT_BYTES = metrics.REGISTRY.counter("mcc_fanout_bytes_total", "Payload bytes distributed to clients")
 
 VERSION = "0.8.0"
 
@@ -59,17 +68,25 @@ class server():
     def __init__(self):
         # Thread handles
         self.csp = None
+        self.dbconn = None
+        self.dblog = None
+        self.archiver = None
         self.connman = None
         self.tracker = None
         self.web = None
+        self.playback = None
+        self.logwriter = None
 
-        # Message queues
+        # Message queues. The uplink scheduler is created with the configuration
         self.inq = Queue.Queue()
-        self.outq = Queue.Queue()
+        self.outq = None
 
         # Connection list
         self.connlist = []
 
+        # Packet broadcast ring
+        self.ring = None
+
         # Register signal handlers
         signal.signal(signal.SIGTERM, self.sig_handler)
         signal.signal(signal.SIGHUP, self.sig_handler)
@@ -85,6 +102,14 @@ class server():
         sys.exit(1)
         
     def cleanup(self):
+        # Stop playback
+        if not self.playback == None:
+            self.mcclog.debug("Stopping playback")
+            self.playback.stop()
+            self.playback.join()
+            self.playback = None
+            self.mcclog.debug("Playback stopped")
+
         # Close CSP
         if not self.csp == None:
             self.mcclog.debug("Closing CSP interface")
@@ -92,6 +117,24 @@ class server():
             self.csp = None
             self.mcclog.debug("CSP closed")
 
+        # Flush and close database logger
+        if not self.dblog == None:
+            self.mcclog.debug("Flushing database log")
+            self.dblog.stop()
+            self.dblog.join()
+            stats = self.dblog.stats()
+            self.mcclog.debug("Database log closed - {0} packets in {1} flushes, average batch {2:.1f}, average latency {3:.1f} ms, {4} dropped, {5} failed".format(
+                stats["logged"], stats["flushes"], stats["avg_batch"], stats["avg_latency"] * 1000, stats["dropped"], stats["failed"]))
+            self.dblog = None
+
+        # Close partition archiver
+        if not self.archiver == None:
+            self.mcclog.debug("Stopping partition archiver")
+            self.archiver.stop()
+            self.archiver.join()
+            self.archiver = None
+            self.mcclog.debug("Partition archiver stopped")
+
         # Close connection manager
         if not self.connman == None:
             self.mcclog.debug("Stopping Connection Manager")
@@ -114,6 +157,13 @@ class server():
             self.web = None
             self.mcclog.debug("Web Inteface closed")
 
+        # Report uplink latency
+        if not self.outq == None:
+            stats = self.outq.stats()
+            for name in [name for (name, prio) in csp.LANES] + ["control"]:
+                lane = stats[name]
+                self.mcclog.debug("Uplink lane {0}: {1} packets, average latency {2:.1f} ms, maximum latency {3:.1f} ms".format(name, lane["packets"], lane["avg"] * 1000, lane["max"] * 1000))
+
         self.mcclog.info("Waiting for {0} connection{1} to close".format(len(self.connlist), ("" if len(self.connlist) == 1 else "s")))
 
         # Close all connections...
@@ -127,6 +177,19 @@ class server():
         else:
             self.mcclog.debug("All connections successfully closed")
 
+        # Close pooled database connections
+        if not self.dbconn == None:
+            stats = self.dbconn.stats()
+            self.mcclog.debug("Database pool: {0} connections opened, {1} evicted, {2} broken, {3} waits for a free connection".format(
+                stats["opened"], stats["evicted"], stats["broken"], stats["waits"]))
+            self.dbconn.close()
+
+        # Write remaining log messages
+        if not self.logwriter == None:
+            self.logwriter.stop()
+            self.logwriter.join()
+            self.logwriter = None
+
     def server(self):
         # Parse configuration
         conf = config.config(VERSION)
@@ -136,7 +199,6 @@ class server():
 
         # Get logging instance
         self.mcclog = logging.getLogger("self.mcclog")
-        self.mcclog.setLevel(logging.DEBUG)
         logformatter = logging.Formatter("[%(levelname)7s] %(asctime)s %(module)s: %(message)s")
         colorformatter = ColorFormatter("[%(levelname)21s] %(asctime)s %(module)s: %(message)s")
         if conf.verbose:
@@ -144,6 +206,10 @@ class server():
         else:
             loglvl = logging.INFO
 
+        # Debug messages are discarded by the logger unless verbose
+        self.mcclog.setLevel(loglvl)
+        handlers = []
+
         if conf.daemon:
             # Daemonize
             try:
@@ -158,14 +224,20 @@ class server():
             else:
                 streamhandler.setFormatter(logformatter)
             streamhandler.setLevel(loglvl)
-            self.mcclog.addHandler(streamhandler)
+            handlers.append(streamhandler)
 
         # Check if logging to file is enabled
         if not conf.logfile == None:
             filehandler = logging.FileHandler(conf.logfile)
             filehandler.setFormatter(logformatter)
             filehandler.setLevel(loglvl)
-            self.mcclog.addHandler(filehandler)
+            handlers.append(filehandler)
+
+        # Handlers are called from the log writer thread
+        queuehandler = logqueue.queuehandler()
+        queuehandler.addFilter(logqueue.sampler(conf.lograte))
+        self.mcclog.addHandler(queuehandler)
+        self.logwriter = logqueue.logwriter(queuehandler, handlers)
 
         # Start the program
         self.mcclog.info("AAUSAT3 MCC Server {0}".format(VERSION))
@@ -184,10 +256,19 @@ class server():
         if not conf.csp_enable:
             self.mcclog.warning("CSP interface disabled. Replay only mode.")
         
+        # Create uplink scheduler
+        try:
+            self.outq = csp.scheduler(conf.uplink_weights, conf.uplink_lanesize)
+        except Exception as e:
+            self.mcclog.error("Failed to create uplink scheduler ({0})".format(e))
+            sys.exit(1)
+
         # Connect to Database
         if conf.db_type == "postgresql":
             try:
                 self.dbconn = database.postgresqlmanager(self.mcclog, conf)
+                if conf.migrate:
+                    self.dbconn.migrate()
                 self.dbconn.test()
             except Exception as e:
                 self.mcclog.error("Failed to start PostgreSQL Database Manager with host={0}, db={1}, user={2} ({3})".format(conf.db_host, conf.db_name, conf.db_user, str(e).replace("\n\t", " ").replace("\n", "")))
@@ -196,7 +277,9 @@ class server():
         elif conf.db_type == "mysql":
             try:
                 self.dbconn = database.mysqlmanager(self.mcclog, conf)
-                self.dbconn.test()        
+                if conf.migrate:
+                    self.dbconn.migrate()
+                self.dbconn.test()
             except Exception as e:
                 self.mcclog.error("Failed to start MySQL Database Manager with host={0}, db={1}, user={2} ({3})".format(conf.db_host, conf.db_name, conf.db_user, str(e).replace("\n\t", " ").replace("\n", "")))
                 sys.exit(1)
@@ -204,7 +287,9 @@ class server():
         elif conf.db_type == "sqlite":
             try:
                 self.dbconn = database.sqlitemanager(self.mcclog, conf)
-                self.dbconn.test()        
+                if conf.migrate:
+                    self.dbconn.migrate()
+                self.dbconn.test()
             except Exception as e:
                 self.mcclog.error("Failed to start SQLite Database Manager for {0} ({1})".format(conf.db_file, e))
                 sys.exit(1)
@@ -213,10 +298,30 @@ class server():
             self.mcclog.error("{0} is not a valid database type. Use either postgresql, mysql or sqlite".format(conf.db_type))
             sys.exit(1) 
 
+        # Exit after migrating database
+        if conf.migrate:
+            sys.exit(0)
+
+        # Start partition archiver
+        if conf.db_retention > 0:
+            try:
+                self.archiver = database.archiver(self.mcclog, self.dbconn, conf)
+            except Exception as e:
+                self.mcclog.error("Failed to start partition archiver ({0})".format(e))
+                sys.exit(1)
+            self.mcclog.info("Started partition archiver, retention {0} days, archive directory {1}".format(conf.db_retention, conf.db_archive))
+
         # Initialize CSP
         if conf.csp_enable:
             try:
-                self.csp = csp.csp(self.mcclog, self.dbconn, self.inq, self.outq, conf)
+                self.dblog = database.dblogger(self.mcclog, self.dbconn, conf)
+            except Exception as e:
+                self.mcclog.error("Failed to start database logger ({0})".format(e))
+                sys.exit(1)
+            self.mcclog.info("Started database logger, batch size {0}, batch time {1} ms".format(conf.db_batchsize, conf.db_batchtime))
+
+            try:
+                self.csp = csp.csp(self.mcclog, self.dblog, self.inq, self.outq, conf)
             except Exception as e:
                 self.mcclog.error("Failed to initialize CSP ({0})".format(e))
                 sys.exit(1)
@@ -240,9 +345,19 @@ class server():
                 sys.exit(1)
             self.mcclog.info("Initialized Web Interface on port {0}".format(conf.web_port))
 
+        # Enable latency tracing
+        if conf.trace:
+            tracing.enable()
+            self.mcclog.info("Packet latency tracing enabled")
+
+        # Queue metrics
+        metrics.REGISTRY.gauge("mcc_inq_depth", "Received packets waiting to be distributed", self.inq.qsize)
+        metrics.REGISTRY.gauge("mcc_outq_depth", "Packets waiting to be sent to CSP", self.outq.qsize)
+
         # Initialize Connection Manager
+        self.ring = ring.ring(conf.ringsize)
         try:
-            self.connman = connmanager.connectionmanager(self.mcclog, self.dbconn, self.connlist, self.outq, conf)
+            self.connman = connmanager.connectionmanager(self.mcclog, self.dbconn, self.connlist, self.ring, self.outq, conf)
         except Exception as e:
             self.mcclog.error("Failed to initialize Connection Manager on port {0}, {1} ({2})".format(
                 conf.listen_port, "connection limit: {0}".format(conf.max_users if int(conf.max_users) > 0 else "none"), e
@@ -256,6 +371,15 @@ class server():
         if not conf.use_tls:
             self.mcclog.warning("TLS encryption is disabled! Eve can read your data...")
 
+        # Initialize Playback
+        if conf.playback_enable:
+            try:
+                self.playback = playback.playback(self.mcclog, self.dbconn, self.inq, conf)
+            except Exception as e:
+                self.mcclog.error("Failed to initialize Playback ({0})".format(e))
+                sys.exit(1)
+            self.mcclog.info("Initialized Playback from {0} to {1}".format(conf.playback_start, conf.playback_stop))
+
         self.mcclog.info("Startup sequence completed - Listening for incoming connections")
 
         # Enter main loop
@@ -278,10 +402,10 @@ class server():
                     tx_packets += 1
                 else:
                     rx_packets += 1
-                self.mcclog.debug("Distributing packet: {0}".format(packet.debug()))
-                self.mcclog.debug("Packets transmitted: {0}, Packets received: {1}".format(tx_packets, rx_packets))
-                # Add packet to packet queues
-                for conn in self.connlist:
-                    if conn.enabled and conn.authorized:
-                        conn.queue.put(packet)
+                tracing.distributed(packet)
+                self.mcclog.debug("Distributing packet: %s (packets transmitted: %d, packets received: %d)", packet, tx_packets, rx_packets, extra=logqueue.PACKET)
+                # Add packet to broadcast ring
+                self.ring.append(packet)
+                FANOUT_PACKETS.inc()
+                FANOUT_BYTES.inc(len(packet.data))
         print "STOPPED unexpect"
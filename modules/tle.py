@@ -19,49 +19,198 @@
 # THE SOFTWARE.
 
 # Fetch TLE from Celestrak
+# The source may also be a local file or a directory of files for offline
+# stations. The last catalogue is cached on disk so elements are available
+# at startup, and downloads are only repeated when the source has changed
 
 # Python imports
 import urllib2
 import time
 import threading
 import re
+import os
+import json
+
+# Seconds before a failed update is retried
+RETRY = 300
+
+# Seconds to wait for the TLE server
+TIMEOUT = 30
+
+class catalog():
+    def __init__(self, text=""):
+        self.text = text
+
+        # Elements indexed by name and by NORAD catalogue number
+        self.names = {}
+        self.ids = {}
+
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        for i in range(len(lines) - 2):
+            if lines[i+1].startswith("1 ") and lines[i+2].startswith("2 ") and not lines[i][:2] in ("1 ", "2 "):
+                # Three line element sets may prefix the name with 0
+                name = re.sub("^0 ", "", lines[i])
+                elements = (name, lines[i+1], lines[i+2])
+                self.names[name] = elements
+                self.ids[lines[i+1][2:7].strip()] = elements
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, key):
+        if key in self.names:
+            return self.names[key]
+        elif key in self.ids:
+            return self.ids[key]
+
+        # Names may be given without their suffix, e.g. AAUSAT-II
+        for name in sorted(self.names):
+            if name.startswith(key):
+                return self.names[name]
+        return None
 
 class tle(threading.Thread):
-    def __init__(self, mcclog, conf):
+    def __init__(self, mcclog, conf, changed=None):
         threading.Thread.__init__(self, None)
         self.mcclog = mcclog
-        self.url = conf.tleurl
+        self.source = conf.tleurl
+        self.cachefile = conf.tlecache
         self.interval = conf.tleupdate
-        self.spacecraft = conf.spacecraft
+        self.spacecraft = [name for (name, priority, frequency) in conf.spacecraft]
+
+        # Called when a new element set is fetched
+        self.changed = changed
         
         # Create event object
         self.event = threading.Event()
         
-        # Reset TLE lines
-        self.line1 = None
-        self.line2 = None
-        self.line3 = None
+        # TLE lines for each spacecraft
+        self.elements = {}
+
+        # Validators of the last download, used for conditional requests
+        self.etag = None
+        self.modified = None
+
+        # Load cached catalogue
+        self.catalog = catalog()
+        self.load()
         
-    def get(self):
-        if not self.line1 == None and not self.line2 == None and not self.line3 == None:
-            return (self.line1, self.line2, self.line3)
-        else:
+    def get(self, spacecraft):
+        try:
+            return self.elements[spacecraft]
+        except KeyError:
             raise Exception("TLE not available")
+
+    def load(self):
+        if not self.cachefile or not os.path.exists(self.cachefile):
+            return
+
+        try:
+            f = open(self.cachefile)
+            cache = json.load(f)
+            f.close()
+
+            # JSON strings load as unicode, which PyEphem does not accept
+            text = cache["text"].encode("ascii")
+            (etag, modified) = [v.encode("ascii") if v != None else None for v in (cache["etag"], cache["modified"])]
+        except Exception as e:
+            self.mcclog.warning("Failed to read TLE cache {0} ({1})".format(self.cachefile, e))
+            return
+
+        # Validators only apply to the source they were received from
+        if cache["source"] == self.source:
+            self.etag = etag
+            self.modified = modified
+        self.catalog = catalog(text)
+        self.mcclog.info("Loaded {0} TLEs from {1}".format(len(self.catalog), self.cachefile))
+        self.select()
+
+    def save(self):
+        if not self.cachefile:
+            return
+
+        try:
+            f = open(self.cachefile + ".tmp", "w")
+            json.dump({"source": self.source, "etag": self.etag, "modified": self.modified, "text": self.catalog.text}, f)
+            f.close()
+            os.rename(self.cachefile + ".tmp", self.cachefile)
+        except Exception as e:
+            self.mcclog.warning("Failed to write TLE cache {0} ({1})".format(self.cachefile, e))
+
+    def select(self):
+        # Look up the spacecraft in the catalogue. Returns the missing spacecraft
+        changed = False
+        missing = []
+        for spacecraft in self.spacecraft:
+            elements = self.catalog.get(spacecraft)
+            if not elements == None:
+                for line in elements:
+                    self.mcclog.debug(line)
+                if not self.elements.get(spacecraft) == elements:
+                    self.elements[spacecraft] = elements
+                    self.mcclog.info("New TLE for {0}".format(spacecraft))
+                    changed = True
+            else:
+                self.mcclog.warning("No match found for {0}".format(spacecraft))
+                missing.append(spacecraft)
+
+        if changed and not self.changed == None:
+            self.changed()
+        return missing
+
+    def fetch(self):
+        # Returns the source text, or None if it has not changed
+        if os.path.isdir(self.source):
+            files = sorted([os.path.join(self.source, name) for name in os.listdir(self.source)])
+            files = [name for name in files if os.path.isfile(name)]
+        elif os.path.isfile(self.source):
+            files = [self.source]
+        else:
+            request = urllib2.Request(self.source)
+            if not self.etag == None:
+                request.add_header("If-None-Match", self.etag)
+            if not self.modified == None:
+                request.add_header("If-Modified-Since", self.modified)
+            try:
+                f = urllib2.urlopen(request, timeout=TIMEOUT)
+            except urllib2.HTTPError as e:
+                if e.code == 304:
+                    return None
+                raise
+            text = f.read()
+            self.etag = f.info().getheader("ETag")
+            self.modified = f.info().getheader("Last-Modified")
+            f.close()
+            return text
+
+        # Local files are only read again when modified
+        modified = ",".join(["{0}:{1}".format(name, os.path.getmtime(name)) for name in files])
+        if modified == self.modified:
+            return None
+        text = ""
+        for name in files:
+            f = open(name)
+            text += f.read() + "\n"
+            f.close()
+        self.etag = None
+        self.modified = modified
+        return text
             
     def update(self):
-        self.mcclog.info("Updating TLE for {0}".format(self.spacecraft))
+        self.mcclog.info("Updating TLE for {0}".format(", ".join(self.spacecraft)))
             
-        # Fetch TLE from Celestrak
         try:
-            f = urllib2.urlopen(self.url)
-            match = re.search("({0}.*)\r\n(.+)\r\n(.+)\r\n".format(self.spacecraft), f.read())
-            if match:
-                (self.line1, self.line2, self.line3) = match.groups()
-                self.mcclog.debug(self.line1)
-                self.mcclog.debug(self.line2)
-                self.mcclog.debug(self.line3)
-            else:
-                raise Exception("No match found for {0}".format(self.spacecraft))
+            text = self.fetch()
+            if text == None:
+                self.mcclog.debug("TLE source {0} not modified".format(self.source))
+                return
+
+            self.catalog = catalog(text)
+            self.save()
+            self.mcclog.debug("Fetched {0} TLEs from {1}".format(len(self.catalog), self.source))
+            missing = self.select()
+            if len(missing) == len(self.spacecraft):
+                raise Exception("No match found for {0}".format(", ".join(missing)))
         except Exception as e:
             self.mcclog.warning("Failed to update TLE: {0}".format(e))
             raise
@@ -80,10 +229,13 @@ class tle(threading.Thread):
 
     def run(self):
         while self.running:
+            # Update TLE, retrying early on failure
+            try:
+                self.update()
+            except Exception:
+                wait = min(RETRY, self.interval * 3600)
+            else:
+                wait = self.interval * 3600
+
             # Wait for next update
-            self.event.wait(self.interval * 3600)
-            if self.event.is_set():
-                continue
-            
-            # Update TLE
-            self.update()
+            self.event.wait(wait)
@@ -0,0 +1,82 @@
+# Copyright (c) 2011 Jeppe Ledet-Pedersen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Packet latency tracing
+# When enabled, received packets carry a list of timestamps taken when read
+# from CSP, when added to the incoming queue and when taken from the queue by
+# the fan-out loop. Each client adds the time the packet was read from the
+# ring and the time it was written to the socket. The time spent between
+# stamps is recorded in per-stage latency histograms.
+
+# Python imports
+import time
+
+# AAUSAT3 imports
+import metrics
+
+# Stages and the stamps they are measured between
+STAGES = [
+    ("reader", "CSP read to incoming queue"),
+    ("inq", "incoming queue to fan-out"),
+    ("fanout", "fan-out to client dequeue"),
+    ("client", "client dequeue to socket write"),
+    ("total", "CSP read to socket write"),
+]
+
+enabled = False
+
+histograms = dict([(name, metrics.REGISTRY.histogram("mcc_latency_{0}_seconds".format(name), "Packet latency from {0}".format(help))) for (name, help) in STAGES])
+
+def enable():
+    global enabled
+    enabled = True
+
+# Start tracing a packet read from CSP at time t
+def start(packet, t):
+    if enabled:
+        packet.trace = [t]
+
+def stamp(packet):
+    if not packet.trace == None:
+        packet.trace.append(time.time())
+
+# Record the stages of a packet taken by the fan-out loop
+def distributed(packet):
+    if not packet.trace == None:
+        packet.trace.append(time.time())
+        (read, queued, distributed) = packet.trace
+        histograms["reader"].observe(queued - read)
+        histograms["inq"].observe(distributed - queued)
+
+# Record a list of traces read from the ring by a client. Returns a token
+# passed to written() when the packets have been written to the socket
+def dequeued(traces):
+    now = time.time()
+    traces = [t for t in traces if not t == None and len(t) == 3]
+    for t in traces:
+        histograms["fanout"].observe(now - t[2])
+    return (now, traces)
+
+def written(token):
+    now = time.time()
+    (dequeued, traces) = token
+    for t in traces:
+        histograms["client"].observe(now - dequeued)
+        histograms["total"].observe(now - t[0])
@@ -27,25 +27,50 @@ import threading
 import re
 import math
 
+# AAUSAT3 imports
+import schedule
+
+# Seconds in a day
+DAY = 86400
+
+# The Unix epoch as a PyEphem date
+EPOCH = 25567.5
+
+# Passes in progress are found by starting the search this long ago
+LOOKBACK = 3600
 
 def doppler_shift(frequency, velocity):
     c = 299792458.0
     return (-velocity * frequency)/c 
 
+def unixtime(date):
+    return (date - EPOCH) * DAY
+
+def ephemdate(t):
+    return ephem.Date(t / DAY + EPOCH)
+
 class tracker(threading.Thread):
     def __init__(self, mcclog, outqueue, conf):
         # Delayed import as ephem should not be required if tracking is not used
-	import ephem
-	import tle
-	import rotor
-	import radio
-        #import ephem        
+        global ephem
+        global pointing
+        import ephem
+        import pointing
+        import tle
+        import rotor
+        import radio
 
         threading.Thread.__init__(self, None)
         self.mcclog = mcclog
         self.outqueue = outqueue
-        self.spacecraft = conf.spacecraft
-        self.frequency = conf.frequency
+        self.spacecraft = [name for (name, priority, frequency) in conf.spacecraft]
+        self.priorities = dict([(name, priority) for (name, priority, frequency) in conf.spacecraft])
+        self.frequencies = dict([(name, frequency) for (name, priority, frequency) in conf.spacecraft])
+        self.policy = conf.conflict
+        self.handover = conf.handover
+        self.days = conf.scheduledays
+        self.resolution = conf.trackresolution
+        self.interval = conf.trackinterval
         
         # Create observer
         self.obs = ephem.Observer()
@@ -56,13 +81,25 @@ class tracker(threading.Thread):
         self.obs.pressure = 0
         self.obs.horizon = math.radians(0.0)
         self.minelv = math.radians(conf.minelv)
+
+        if not self.policy in schedule.POLICIES:
+            raise Exception("Unknown conflict policy {0}".format(self.policy))
+        for (name, frequency) in self.frequencies.items():
+            if not radio.valid(conf.frequency, frequency):
+                raise Exception("Frequency {0:.0f} of {1} is outside the radio range".format(frequency, name))
+
+        # Current PyEphem body of each spacecraft
+        self.bodies = {}
         
         # Create event object
         self.event = threading.Event()
+
+        # Last pass announced in the log and its pointing table
+        self.announced = None
+        self.table = None
         
-        # Update TLE
-        self.tle = tle.tle(self.mcclog, conf)
-        self.tle.update()
+        # Load cached TLE. The pass schedule is recomputed when it changes
+        self.tle = tle.tle(self.mcclog, conf, self.event.set)
 
         # Create rotor
         self.rotor = rotor.rotor(self.mcclog, conf)
@@ -70,7 +107,7 @@ class tracker(threading.Thread):
         # Create radio
         self.radio = radio.radio(self.mcclog, self.outqueue, conf)
         
-        # Start TLE auto updater
+        # Start TLE auto updater. The first update runs immediately
         self.tle.auto_enable()
         
         # Set thread state - self.daemon is important!
@@ -83,102 +120,166 @@ class tracker(threading.Thread):
     def stop(self):
         self.tle.stop()
         self.tle.join()
+        self.rotor.stop()
+        self.rotor.join()
         self.running = False
         self.event.set()
 
+    def find_passes(self, spacecraft, sc, start, stop):
+        passes = []
+        self.obs.date = ephemdate(start)
+        stop = ephemdate(stop)
+        while self.obs.date < stop:
+            try:
+                # Find next pass
+                tr, azr, tt, altt, ts, azs = self.obs.next_pass(sc)
+            except:
+                # No pass found in near future
+                self.obs.date = ephem.Date(self.obs.date + ephem.hour)
+                continue
+
+            if tr == None or ts == None:
+                # Spacecraft does not rise or set
+                self.obs.date = ephem.Date(self.obs.date + ephem.hour)
+                continue
+            elif tr > stop:
+                break
+
+            # Test if pass meets minimum elevation requirement
+            if altt > self.minelv and tr < ts:
+                passes.append(schedule.satpass(spacecraft, unixtime(tr), unixtime(tt), unixtime(ts),
+                    math.degrees(altt), math.degrees(azr), math.degrees(azs)))
+            self.obs.date = ephem.Date(max(tr, ts) + ephem.minute)
+
+        return passes
+
+    def plan(self):
+        now = time.time()
+        until = now + self.days * DAY
+        for spacecraft in self.spacecraft:
+            # Read most recent TLE
+            try:
+                tle = self.tle.get(spacecraft)
+            except:
+                continue
+
+            # Recompute the passes for a new element set, otherwise only
+            # search the days not yet covered
+            if not tle == schedule.SCHEDULE.elements.get(spacecraft):
+                self.bodies[spacecraft] = ephem.readtle(tle[0].strip(), tle[1], tle[2])
+                passes = self.find_passes(spacecraft, self.bodies[spacecraft], now - LOOKBACK, until)
+                schedule.SCHEDULE.replace(spacecraft, tle, passes, until)
+                self.mcclog.info("Found {0} passes for {1} in the next {2} days".format(len(passes), spacecraft, self.days))
+            elif schedule.SCHEDULE.horizons[spacecraft] < until:
+                passes = self.find_passes(spacecraft, self.bodies[spacecraft], schedule.SCHEDULE.horizons[spacecraft], until)
+                schedule.SCHEDULE.extend(spacecraft, passes, until)
+                self.mcclog.debug("Extended pass schedule for {0} with {1} passes".format(spacecraft, len(passes)))
+
+        if not self.bodies:
+            raise Exception("TLE not available")
+
+        skipped = schedule.SCHEDULE.resolve(self.policy, self.priorities, self.handover)
+        if skipped:
+            self.mcclog.debug("Skipping {0} conflicting passes".format(skipped))
+
+    def announce(self, p):
+        sc = self.bodies[p.spacecraft]
+        self.table = pointing.pointing(self.obs, sc, p.aos, p.los, self.frequencies[p.spacecraft], self.resolution)
+        self.mcclog.info("Next pass for {0} (Orbit {1})".format(p.spacecraft, sc._orbit))
+        self.mcclog.info("AOS: {0}".format(datetime.datetime.fromtimestamp(p.aos).strftime("%Y-%m-%d %H:%M:%S")))
+        self.mcclog.info("Transit: {0}".format(datetime.datetime.fromtimestamp(p.tca).strftime("%Y-%m-%d %H:%M:%S")))
+        self.mcclog.info("LOS: {0}".format(datetime.datetime.fromtimestamp(p.los).strftime("%Y-%m-%d %H:%M:%S")))
+        self.mcclog.info("Pass length: {0}".format(datetime.timedelta(seconds=int(p.los - p.aos))))
+        self.mcclog.info("Maximum elevation: {0:.1f} degrees".format(p.maxelv))
+        self.mcclog.debug("""---------------------------------------------------------------------""")
+        self.mcclog.debug("""      Date/Time        Elev/Azim    Alt     Range     RVel    FreqAdj""")
+        self.mcclog.debug("""---------------------------------------------------------------------""")
+        t = p.aos
+        while t <= p.los:
+            (az, elv) = self.table.position(t)
+            self.mcclog.debug("{0} | {1:4.1f} {2:5.1f} | {3:5.1f} | {4:6.1f} | {5:+7.1f} | {6:+7.1f}".format(
+                datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S"),
+                elv,
+                az,
+                self.table.interpolate(self.table.alt, t)/1000.,
+                self.table.interpolate(self.table.range, t)/1000.,
+                self.table.interpolate(self.table.range_velocity, t),
+                self.table.shift(t)))
+            t += 60
+
+    # A correction the radio rejects must not stop tracking
+    def retune(self, frequency):
+        try:
+            self.radio.set_frequency(frequency)
+        except Exception as e:
+            self.mcclog.warning("Unable to set radio frequency ({0})".format(e))
+
     def run(self):
         # Wait for initialization to settle
         time.sleep(0.25)
 
         while self.running:
-            # Find time of upcoming pass
+            self.event.clear()
+
+            # Update pass schedule
             try:
-                # Read most recent TLE
-                tle = self.tle.get()
-            except:
+                self.plan()
+            except Exception as e:
                 # TLE not available
+                self.mcclog.debug("Pass schedule not available ({0})".format(e))
                 self.event.wait(60)
                 continue
-            else:
-                # Compute current spacecraft position
-                sc = ephem.readtle(tle[0].strip(), tle[1], tle[2])
-                sc.compute(self.obs)
-                start = ephem.now()
-                self.obs.date = ephem.now()                
-
-                # Check pass minimum elevation
-                while self.obs.date < ephem.Date(start + 24.0 * ephem.hour):
-                    try:
-                        # Find next pass
-                        tr, azr, tt, altt, ts, azs = self.obs.next_pass(sc)
-                    except:
-                        # No pass found in near future
-                        self.obs.date = ephem.Date(self.obs.date + ephem.hour)
-                        continue
-                    else:
-                        # Test if pass meets minimum elevation requirement
-                        if altt > self.minelv and tr < ts:
-                            self.mcclog.info("Next pass for {0} (Orbit {1})".format(self.spacecraft, sc._orbit))
-                            self.mcclog.info("AOS: {0}".format(ephem.localtime(tr).strftime("%Y-%m-%d %H:%M:%S")))
-                            self.mcclog.info("Transit: {0}".format(ephem.localtime(tt).strftime("%Y-%m-%d %H:%M:%S")))
-                            self.mcclog.info("LOS: {0}".format(ephem.localtime(ts).strftime("%Y-%m-%d %H:%M:%S")))
-                            self.mcclog.info("Pass length: {0}".format(ephem.localtime(ts) - ephem.localtime(tr)))
-                            self.mcclog.info("Maximum elevation: {0:.1f} degrees".format(math.degrees(altt)))
-                            self.mcclog.debug("""---------------------------------------------------------------------""")
-                            self.mcclog.debug("""      Date/Time        Elev/Azim    Alt     Range     RVel    FreqAdj""")
-                            self.mcclog.debug("""---------------------------------------------------------------------""")
-                            self.obs.date = tr
-                            while self.obs.date <= ts:
-                                sc.compute(self.obs)
-                                self.mcclog.debug("{0} | {1:4.1f} {2:5.1f} | {3:5.1f} | {4:6.1f} | {5:+7.1f} | {6:+7.1f}".format(
-                                    ephem.localtime(self.obs.date).strftime("%Y-%m-%d %H:%M:%S"),
-                                    math.degrees(sc.alt),
-                                    math.degrees(sc.az),
-                                    sc.elevation/1000.,
-                                    sc.range/1000.,
-                                    sc.range_velocity,
-                                    doppler_shift(self.frequency, sc.range_velocity)))
-                                self.obs.date = ephem.Date(self.obs.date + ephem.minute)
-                            break
-                        else:
-                            self.obs.date = ephem.Date(self.obs.date + ephem.hour)
-                            continue
-
-                else:
-                    self.mcclog.warning("No passes found for {0}!".format(self.spacecraft))
-                    # Wait for next try
-                    self.event.wait(3600)
+
+            p = schedule.SCHEDULE.next()
+            if p == None:
+                self.mcclog.warning("No passes found for {0}!".format(", ".join(self.spacecraft)))
+                # Wait for next try
+                self.event.wait(3600)
+                continue
+
+            if not p is self.announced:
+                self.announce(p)
+                self.announced = p
+
+            # Wait for next pass. A new TLE wakes the tracker to update the schedule
+            sec = p.aos - time.time()
+            if sec > self.handover:
+                self.mcclog.info("Waiting {0} seconds for AOS".format(int(sec)))
+                self.event.wait(sec - self.handover)
+                if self.event.is_set():
                     continue
 
-                # Wait for next pass
-                delta = ephem.localtime(tr) - datetime.datetime.today()
-                sec = delta.seconds + 24 * 60 * delta.days
-                self.mcclog.info("Waiting {0} seconds for AOS".format(sec))
+            # Hand the rotor and radio over to the spacecraft before AOS
+            frequency = self.frequencies[p.spacecraft]
+            sec = p.aos - time.time()
+            if sec > 0:
+                self.mcclog.info("Moving rotor to AOS position for {0}".format(p.spacecraft))
+                (az, elv) = self.table.position(p.aos)
+                self.rotor.set_position(az, elv)
+                self.retune(frequency + self.table.shift(p.aos))
                 self.event.wait(sec)
-                
-                # Exit if event was set
                 if self.event.is_set():
                     continue
 
-                # Handle pass
-                self.mcclog.info("AOS for {0}".format(self.spacecraft))
-                self.obs.date = ephem.now()
-                while self.obs.date <= ts:
-                    # Calculate spacecraft position
-                    sc.compute(self.obs)
-                    
-                    # Adjust rotor position
-                    self.rotor.set_position(math.degrees(sc.az), math.degrees(sc.alt))
-                    
-                    # Adjust radio frequency                    
-                    self.radio.set_frequency(self.frequency + doppler_shift(self.frequency, sc.range_velocity))
-
-                    # Wait for next update
-                    self.obs.date = ephem.Date(self.obs.date + 2 * ephem.second)
-                    self.event.wait(2)
-                    
-                    # Exit if event was set
-                    if self.event.is_set():
-                        return
-                    
-                self.mcclog.info("LOS for {0}".format(self.spacecraft))
+            # Handle pass
+            self.mcclog.info("AOS for {0}".format(p.spacecraft))
+            while self.running and time.time() <= p.los:
+                # Look up spacecraft position
+                now = time.time()
+                (az, elv) = self.table.position(now)
+                
+                # Adjust rotor position
+                self.rotor.set_position(az, elv)
+                
+                # Adjust radio frequency
+                self.retune(frequency + self.table.shift(now))
+
+                # Wait for next update
+                self.event.wait(self.interval)
+                self.event.clear()
+                
+            # Exit if tracker was stopped
+            if not self.running:
+                return
+
+            self.mcclog.info("LOS for {0}".format(p.spacecraft))
@@ -25,6 +25,10 @@ import threading
 import ssl
 import BaseHTTPServer
 
+# AAUSAT3 imports
+import metrics
+import schedule
+
 page = """<html>
 <head>
 <title>AAUSAT3 Mission Control Center</title>
@@ -64,6 +68,20 @@ class webhandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 self.end_headers()
                 self.wfile.write(page.format("".join(["{0:02x}".format(ord(i)) for i in token])))
             return
+        elif self.path == "/metrics":
+            body = metrics.REGISTRY.export()
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4")
+            self.send_header("Content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/passes":
+            body = "".join(["{0}\n".format(p) for p in schedule.SCHEDULE.upcoming()])
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain")
+            self.send_header("Content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
         else:
             self.send_response(404)
             self.send_header("Content-type", "text/html")
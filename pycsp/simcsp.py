@@ -0,0 +1,215 @@
+# Copyright (c) 2011 Jeppe Ledet-Pedersen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Simulated libcsp
+# Pure Python replacement for the pycsp bindings used by the MCC. Installing
+# it as the pycsp module lets the server run without CAN hardware or
+# libpycsp.so. Promiscuous reads return generated packets at a configured
+# rate. The first 8 bytes of each payload hold the generation time as a
+# little endian double, so receivers can measure end-to-end latency.
+#
+#   import simcsp
+#   simcsp.configure(packet_rate=1000, packet_size=64)
+#   sys.modules["pycsp"] = simcsp
+
+import ctypes
+import struct
+import threading
+import time
+
+# CSP Configuration
+CSP_MAX_BIND_PORT   = 31
+CSP_ANY             = (CSP_MAX_BIND_PORT + 1)
+CSP_PROMISC         = (CSP_MAX_BIND_PORT + 2)
+
+# Priorities
+CSP_PRIO_CRITICAL   = 0
+CSP_PRIO_HIGH       = 1
+CSP_PRIO_NORM       = 2
+CSP_PRIO_LOW        = 3
+
+# Routing
+CSP_NODE_MAC        = 0xFF
+CSP_DEFAULT_ROUTE   = 32
+
+# Debug hook
+CSP_INFO            = 0
+CSP_ERROR           = 1
+CSP_WARN            = 2
+
+class NullPointerException(Exception):
+    pass
+
+class CspException(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return str(self.value)
+
+# Packet layout matching pycsp
+class csp_id_fields_t (ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [("flags", ctypes.c_uint, 8),
+                ("sport", ctypes.c_uint, 6),
+                ("dport", ctypes.c_uint, 6),
+                ("dst", ctypes.c_uint, 5),
+                ("src", ctypes.c_uint, 5),
+                ("pri", ctypes.c_uint, 2)]
+
+class csp_id_t (ctypes.Union):
+    _pack_ = 1
+    _anonymous_ = ("id",)
+    _fields_ = [("ext", ctypes.c_uint32),
+                ("id", csp_id_fields_t)]
+
+class csp_packet_t (ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [("padding", ctypes.c_uint8 * 46),
+                ("length", ctypes.c_uint16),
+                ("id", csp_id_t),
+                ("data", ctypes.c_uint8 * 256)]
+
+class can_socketcan_conf (ctypes.Structure):
+    _fields_ = [("ifc", ctypes.c_char_p)]
+
+DEBUG_FUNC = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_char_p)
+
+csp_if_can = None
+
+# Generator settings and statistics
+rate = 0
+size = 8
+source = 1
+dport = 10
+generated = 0
+sent = 0
+
+# Number of packet buffers
+buffers = 25
+allocated = {}
+lock = threading.Lock()
+
+# Time the next packet is due
+due = None
+
+def configure(packet_rate, packet_size, packet_buffers=25):
+    global rate, size, buffers, due
+    rate = packet_rate
+    size = max(8, min(256, packet_size))
+    buffers = packet_buffers
+    due = None
+
+# Buffers
+def csp_buffer_init(count, size):
+    pass
+
+def csp_buffer_get(length):
+    with lock:
+        if len(allocated) >= buffers:
+            raise NullPointerException
+        packet = csp_packet_t()
+        allocated[ctypes.addressof(packet)] = packet
+    return ctypes.addressof(packet)
+
+def csp_buffer_free(packet):
+    with lock:
+        allocated.pop(ctypes.addressof(packet.contents), None)
+
+def csp_buffer_remaining():
+    return buffers - len(allocated)
+
+# Initialization and routing
+def csp_init(address):
+    pass
+
+def csp_can_init(mode, conf, size):
+    return 0
+
+def csp_route_set(node, ifc, mac):
+    pass
+
+def csp_route_start_task(stack, prio):
+    pass
+
+def csp_debug_hook_set(hook):
+    pass
+
+# Promiscuous mode returns generated packets paced at rate packets per second
+def csp_promisc_enable(depth):
+    return 1
+
+def csp_promisc_read(timeout):
+    global due, generated
+    now = time.time()
+    if rate <= 0:
+        time.sleep(timeout / 1000.0)
+        raise NullPointerException
+    if due == None:
+        due = now
+    if due - now > timeout / 1000.0:
+        time.sleep(timeout / 1000.0)
+        raise NullPointerException
+    if due > now:
+        time.sleep(due - now)
+    due += 1.0 / rate
+
+    address = csp_buffer_get(size)
+    packet = ctypes.cast(address, ctypes.POINTER(csp_packet_t))
+    packet.contents.id.src = source
+    packet.contents.id.dst = 10
+    packet.contents.id.sport = 0
+    packet.contents.id.dport = dport
+    packet.contents.length = size
+    data = struct.pack("<d", time.time()).ljust(size, "\0")
+    ctypes.memmove(packet.contents.data, data, size)
+    generated += 1
+    return packet
+
+# Connections. Outgoing packets are counted and discarded
+def csp_connect(prio, dest, dport, timeout, opts):
+    return object()
+
+def csp_send(conn, packet, timeout):
+    global sent
+    sent += 1
+    csp_buffer_free(packet)
+    return 1
+
+def csp_close(conn):
+    pass
+
+def csp_socket(opts):
+    return object()
+
+def csp_bind(socket, port):
+    pass
+
+def csp_listen(socket, backlog):
+    pass
+
+def csp_accept(socket, timeout):
+    time.sleep(timeout / 1000.0)
+    raise NullPointerException
+
+def csp_read(conn, timeout):
+    raise NullPointerException
+
+def csp_service_handler(conn, packet):
+    pass